@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime, timezone
+import boto3
+import numpy as np
+import logging
+from botocore.exceptions import ClientError
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s"
+)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
+# local staging directory for bundles being written or read by pipeline stages
+BUNDLE_WORK_DIR = os.getenv("BUNDLE_WORK_DIR", "/tmp/artifact_bundles")
+
+BUNDLE_FORMAT_VERSION = 1
+IDS_FILE = "item_ids.npy"
+VECTORS_FILE = "vectors.npy"
+MANIFEST_NAME = "manifest.json"
+# rows copied per step when writing a (possibly memory-mapped) matrix
+COPY_CHUNK_ROWS = 100000
+
+s3 = boto3.client("s3", region_name=REGION)
+
+
+class ArtifactChangedError(RuntimeError):
+    """A pinned artifact was overwritten after the manifest that references it was read."""
+
+
+def object_pin(response):
+    """ETag and (on versioned buckets) VersionId of a put/head response, as stored in manifests."""
+    pin = {"etag": response["ETag"]}
+    if response.get("VersionId"):
+        pin["version_id"] = response["VersionId"]
+    return pin
+
+
+def pin_args(etag=None, version_id=None):
+    """get_object arguments that fetch exactly the pinned object."""
+    args = {}
+    if etag:
+        args["IfMatch"] = etag
+    if version_id:
+        args["VersionId"] = version_id
+    return args
+
+
+def download_object(client, key, path, pin=None):
+    """Streams an S3 object to path; with a pin, only that exact object.
+
+    get_object is used because download_file does not accept IfMatch.
+    """
+    response = client.get_object(Bucket=S3_BUCKET, Key=key, **pin_args(**(pin or {})))
+    with open(path, "wb") as f:
+        shutil.copyfileobj(response["Body"], f, 1 << 20)
+
+
+def is_precondition_failed(error):
+    return error.response["Error"]["Code"] in ("PreconditionFailed", "412")
+
+
+def bundle_key(prefix, name):
+    return f"{prefix.rstrip('/')}/{name}"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_checksum(path, sha256, key):
+    """Raises ValueError unless the file at path has the given SHA-256; no-op without one."""
+    if sha256 and file_sha256(path) != sha256:
+        raise ValueError(f"Checksum mismatch for {key}; the bundle may have been republished.")
+
+
+def write_bundle(prefix, item_ids, vectors, dtype="float32", metadata=None, work_dir=BUNDLE_WORK_DIR):
+    """Publishes item IDs and their vectors as a versioned bundle under prefix.
+
+    The bundle is an int64 item_ids.npy, a vectors.npy matrix in dtype
+    (float32 or float16) and a manifest.json with shapes, dtype and SHA-256
+    checksums. Both arrays are plain .npy files, so readers memory-map them
+    without unpickling. The manifest is uploaded last and is what readers
+    look for first. The returned manifest also carries "pins", the ETag (and
+    VersionId) of every uploaded object by key, for the artifact manifest.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    item_ids = np.asarray(item_ids).astype(np.int64, copy=False)
+    if len(item_ids) != vectors.shape[0]:
+        raise ValueError(f"{len(item_ids)} item IDs for {vectors.shape[0]} vectors.")
+    local_prefix = os.path.join(work_dir, prefix.strip("/").replace("/", "_"))
+
+    ids_path = f"{local_prefix}_{IDS_FILE}"
+    np.save(ids_path, item_ids, allow_pickle=False)
+    vectors_path = f"{local_prefix}_{VECTORS_FILE}"
+    out = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=dtype, shape=vectors.shape)
+    for start in range(0, vectors.shape[0], COPY_CHUNK_ROWS):
+        out[start:start + COPY_CHUNK_ROWS] = vectors[start:start + COPY_CHUNK_ROWS]
+    out.flush()
+    del out
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "num_items": int(len(item_ids)),
+        "dim": int(vectors.shape[1]),
+        "dtype": np.dtype(dtype).name,
+        "files": {},
+    }
+    manifest.update(metadata or {})
+    pins = {}
+    for name, path, file_dtype in ((IDS_FILE, ids_path, "int64"), (VECTORS_FILE, vectors_path, manifest["dtype"])):
+        key = bundle_key(prefix, name)
+        manifest["files"][name] = {"key": key, "dtype": file_dtype, "bytes": os.path.getsize(path), "sha256": file_sha256(path)}
+        s3.upload_file(path, S3_BUCKET, key)
+        pins[key] = manifest["files"][name]["pin"] = object_pin(s3.head_object(Bucket=S3_BUCKET, Key=key))
+        logging.info("Uploaded %s to s3://%s/%s", path, S3_BUCKET, key)
+
+    manifest_key = bundle_key(prefix, MANIFEST_NAME)
+    response = s3.put_object(Bucket=S3_BUCKET, Key=manifest_key, Body=json.dumps(manifest, indent=2).encode("utf-8"))
+    pins[manifest_key] = object_pin(response)
+    logging.info("Bundle with %d items (dim %d, %s) published to s3://%s/%s",
+                 manifest["num_items"], manifest["dim"], manifest["dtype"], S3_BUCKET, prefix)
+    return dict(manifest, pins=pins)
+
+
+def read_manifest(prefix, pin=None):
+    """Returns the bundle manifest under prefix, or None if none is published.
+
+    With a pin, only that exact object is accepted; ArtifactChangedError is
+    raised if the manifest has been replaced since.
+    """
+    key = bundle_key(prefix, MANIFEST_NAME)
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=key, **pin_args(**(pin or {})))
+    except ClientError as e:
+        if pin and is_precondition_failed(e):
+            raise ArtifactChangedError(f"{key} changed after it was pinned.") from e
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def download_to_work_dir(key, pin=None, sha256=None, work_dir=BUNDLE_WORK_DIR):
+    os.makedirs(work_dir, exist_ok=True)
+    local_path = os.path.join(work_dir, key.replace("/", "_"))
+    try:
+        download_object(s3, key, local_path, pin)
+    except ClientError as e:
+        if pin and is_precondition_failed(e):
+            raise ArtifactChangedError(f"{key} changed after it was pinned.") from e
+        raise
+    verify_checksum(local_path, sha256, key)
+    return local_path
+
+
+def read_bundle(prefix, fetch=download_to_work_dir, verify=True, pins=None):
+    """Loads a bundle as read-only memory-mapped arrays.
+
+    fetch(key, pin, sha256) maps an S3 key to a local path (e.g. a cached
+    download); with verify it gets the manifest's SHA-256 to check whatever
+    it downloads, so a cached copy is not hashed again on every load. pins
+    maps keys to the ETag/VersionId recorded by the artifact manifest; files
+    without one are pinned to the bundle manifest's own record. Sizes are
+    always checked against the manifest. Returns (manifest, item_ids,
+    vectors), or None if no bundle exists.
+    """
+    pins = pins or {}
+    manifest = read_manifest(prefix, pins.get(bundle_key(prefix, MANIFEST_NAME)))
+    if manifest is None:
+        logging.warning("No artifact bundle found at s3://%s/%s", S3_BUCKET, prefix)
+        return None
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported bundle format {manifest.get('format_version')} at {prefix}.")
+
+    arrays = {}
+    for name in (IDS_FILE, VECTORS_FILE):
+        entry = manifest["files"][name]
+        path = fetch(entry["key"], pins.get(entry["key"]) or entry.get("pin"), entry["sha256"] if verify else None)
+        if os.path.getsize(path) != entry["bytes"]:
+            raise ValueError(f"Size mismatch for {entry['key']}; the bundle may have been republished.")
+        arrays[name] = np.load(path, mmap_mode="r", allow_pickle=False)
+
+    item_ids, vectors = arrays[IDS_FILE], arrays[VECTORS_FILE]
+    if item_ids.dtype != np.int64 or vectors.shape != (manifest["num_items"], manifest["dim"]) or vectors.dtype.name != manifest["dtype"]:
+        raise ValueError(f"Bundle at {prefix} does not match its manifest.")
+    logging.info("Loaded bundle %s: %d items, dim %d, %s.", prefix, manifest["num_items"], manifest["dim"], manifest["dtype"])
+    return manifest, item_ids, vectors
@@ -0,0 +1,207 @@
+import os
+import io
+import json
+import time
+import boto3
+import numpy as np
+import faiss
+import logging
+from ML import query_faiss
+from ML.train_faiss_index import (
+    load_embeddings,
+    normalize_vectors,
+    index_spec_from_env,
+    create_index,
+    train_index,
+    IVF_TRAIN_SAMPLE,
+)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s"
+)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
+BENCHMARK_REPORT_FILE = os.getenv("BENCHMARK_REPORT_FILE", "faiss_benchmark.json")
+# optional local copy of the report, e.g. /tmp/faiss_benchmark.json; unset writes only to S3
+BENCHMARK_LOCAL_REPORT = os.getenv("BENCHMARK_LOCAL_REPORT")
+
+BENCHMARK_QUERIES = int(os.getenv("BENCHMARK_QUERIES", 1000))
+BENCHMARK_K = int(os.getenv("BENCHMARK_K", 10))
+BENCHMARK_TARGET_RECALL = float(os.getenv("BENCHMARK_TARGET_RECALL", 0.95))
+# optional JSON list of index specs (see train_faiss_index.index_spec_from_env) replacing the default grid
+BENCHMARK_CONFIGS = os.getenv("BENCHMARK_CONFIGS")
+
+# search-time sweeps, applied to each built index without rebuilding it
+NPROBE_SWEEP = [1, 4, 16, 64, 256]
+EF_SEARCH_SWEEP = [16, 32, 64, 128, 256]
+RERANK_SWEEP = [1, 4]
+# FAISS search parameter -> index spec field, so reported specs carry the swept value
+SPEC_FIELDS = {"nprobe": "nprobe", "efSearch": "ef_search"}
+
+s3 = boto3.client("s3", region_name=REGION)
+
+
+def default_configs():
+    base = index_spec_from_env()
+    return [
+        dict(base, index_type="flat"),
+        dict(base, index_type="ivf_flat"),
+        dict(base, index_type="ivf_pq"),
+        dict(base, index_type="hnsw", hnsw_m=16),
+        dict(base, index_type="hnsw", hnsw_m=32),
+        dict(base, index_type="sq8"),
+    ]
+
+
+def split_queries(vectors, n_queries, seed=0):
+    """Holds out n_queries random vectors, at most a tenth but at least one; returns (database, queries)."""
+    if vectors.shape[0] < 2:
+        raise ValueError(f"Need at least 2 embeddings to benchmark, found {vectors.shape[0]}.")
+    n_queries = max(1, min(n_queries, vectors.shape[0] // 10))
+    rng = np.random.default_rng(seed)
+    held_out = np.zeros(vectors.shape[0], dtype=bool)
+    held_out[rng.choice(vectors.shape[0], n_queries, replace=False)] = True
+    return np.ascontiguousarray(vectors[~held_out]), np.ascontiguousarray(vectors[held_out])
+
+
+def recall_at_k(found, ground_truth):
+    k = ground_truth.shape[1]
+    hits = sum(len(set(found[i, :k]) & set(ground_truth[i])) for i in range(ground_truth.shape[0]))
+    return hits / ground_truth.size
+
+
+def time_queries(index, database, queries, k, rerank_factor):
+    """Per-query latencies (ms) for one-row searches, as the API issues them."""
+    latencies = np.empty(queries.shape[0])
+    found = np.empty((queries.shape[0], k), dtype=np.int64)
+    for i in range(queries.shape[0]):
+        start = time.perf_counter()
+        _, indices = query_faiss.search_with_rerank(index, database, queries[i:i + 1], k, rerank_factor)
+        latencies[i] = (time.perf_counter() - start) * 1000
+        found[i] = indices[0]
+    return latencies, found
+
+
+def search_param_sweep(spec, search_params):
+    if "nprobe" in search_params:
+        return [{"nprobe": nprobe} for nprobe in NPROBE_SWEEP if nprobe <= spec["nlist"]]
+    if "efSearch" in search_params:
+        return [{"efSearch": ef} for ef in EF_SEARCH_SWEEP]
+    return [{}]
+
+
+def benchmark_config(spec, database, queries, ground_truth, k):
+    """Builds one index config and measures it at every search-parameter setting."""
+    n, dim = database.shape
+    start = time.perf_counter()
+    index, search_params = create_index(dim, n, spec)
+    train_index(index, database, max(IVF_TRAIN_SAMPLE * getattr(index, "nlist", 1), 10000))
+    index.add(database)
+    build_seconds = time.perf_counter() - start
+    memory_mb = faiss.serialize_index(index).nbytes / 2 ** 20
+    # record the resolved nlist so a recommended spec can be fed back to training as-is
+    spec = dict(spec, nlist=getattr(index, "nlist", spec.get("nlist")))
+    compressed = spec["index_type"] in ("ivf_pq", "sq8")
+
+    results = []
+    for params in search_param_sweep(spec, search_params):
+        query_faiss.apply_search_params(index, params)
+        for rerank_factor in (RERANK_SWEEP if compressed else [1]):
+            latencies, found = time_queries(index, database, queries, k, rerank_factor)
+            result = {
+                "index_spec": dict(spec, **{SPEC_FIELDS[name]: value for name, value in params.items()}),
+                "search_params": params,
+                "rerank_factor": rerank_factor,
+                "recall_at_k": round(recall_at_k(found, ground_truth), 4),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 4),
+                "build_seconds": round(build_seconds, 2),
+                "memory_mb": round(memory_mb, 2),
+            }
+            logging.info("%s %s rerank=%d: recall@%d=%.4f p50=%.3fms p99=%.3fms",
+                         spec["index_type"], params, rerank_factor, k, result["recall_at_k"], result["p50_ms"], result["p99_ms"])
+            results.append(result)
+    return results
+
+
+def pick_cheapest(results, target_recall):
+    """Lowest p99 latency (then memory) among configs that reach target_recall."""
+    eligible = [r for r in results if r["recall_at_k"] >= target_recall]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda r: (r["p99_ms"], r["memory_mb"]))
+
+
+def format_table(results, k):
+    header = f"{'index':<10} {'params':<18} {'rerank':>6} {f'recall@{k}':>10} {'p50 ms':>8} {'p99 ms':>8} {'build s':>8} {'mem MB':>8}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        params = ",".join(f"{name}={value}" for name, value in r["search_params"].items()) or "-"
+        lines.append(
+            f"{r['index_spec']['index_type']:<10} {params:<18} {r['rerank_factor']:>6} {r['recall_at_k']:>10.4f} "
+            f"{r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['build_seconds']:>8.2f} {r['memory_mb']:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def save_report(report):
+    payload = json.dumps(report, indent=2).encode("utf-8")
+    if BENCHMARK_LOCAL_REPORT:
+        os.makedirs(os.path.dirname(os.path.abspath(BENCHMARK_LOCAL_REPORT)), exist_ok=True)
+        with open(BENCHMARK_LOCAL_REPORT, "wb") as f:
+            f.write(payload)
+        logging.info("Benchmark report written to %s", BENCHMARK_LOCAL_REPORT)
+    s3.upload_fileobj(io.BytesIO(payload), S3_BUCKET, BENCHMARK_REPORT_FILE)
+    logging.info("Benchmark report saved to s3://%s/%s", S3_BUCKET, BENCHMARK_REPORT_FILE)
+
+
+def main():
+    logging.info("Starting FAISS index benchmark.")
+    _, vectors = load_embeddings()
+    vectors = normalize_vectors(np.array(vectors, dtype=np.float32))
+    database, queries = split_queries(vectors, BENCHMARK_QUERIES)
+    logging.info("Benchmarking %d held-out queries against %d vectors.", queries.shape[0], database.shape[0])
+
+    # exact ground truth from the current flat index type
+    exact = faiss.IndexFlatL2(database.shape[1])
+    exact.add(database)
+    _, ground_truth = exact.search(queries, BENCHMARK_K)
+
+    configs = json.loads(BENCHMARK_CONFIGS) if BENCHMARK_CONFIGS else default_configs()
+    results = []
+    for spec in configs:
+        results.extend(benchmark_config(spec, database, queries, ground_truth, BENCHMARK_K))
+
+    best = pick_cheapest(results, BENCHMARK_TARGET_RECALL)
+    logging.info("FAISS benchmark results:\n%s", format_table(results, BENCHMARK_K))
+    if best is None:
+        logging.warning("No configuration reached recall@%d >= %.2f.", BENCHMARK_K, BENCHMARK_TARGET_RECALL)
+    else:
+        logging.info("Cheapest config with recall@%d >= %.2f: %s %s rerank=%d",
+                     BENCHMARK_K, BENCHMARK_TARGET_RECALL, best["index_spec"]["index_type"], best["search_params"], best["rerank_factor"])
+
+    save_report({
+        "k": BENCHMARK_K,
+        "num_queries": int(queries.shape[0]),
+        "num_vectors": int(database.shape[0]),
+        "target_recall": BENCHMARK_TARGET_RECALL,
+        "results": results,
+        "recommended": best,
+    })
+    logging.info("Benchmark complete.")
+
+
+def benchmark_faiss_index():
+    """Main function to benchmark candidate FAISS index configurations."""
+    try:
+        main()
+    except Exception as e:
+        logging.error("Error during FAISS index benchmark: %s", e, exc_info=True)
+        raise
+
+
+if __name__ == "__main__":
+    benchmark_faiss_index()
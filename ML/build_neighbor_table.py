@@ -0,0 +1,137 @@
+import os
+import io
+import json
+from datetime import datetime, timezone
+import boto3
+import numpy as np
+import logging
+from ML import query_faiss, artifact_bundle
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s"
+)
+
+REGION = os.getenv("AWS_REGION", "us-east-1")
+S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
+NEIGHBOR_IDS_FILE = os.getenv("NEIGHBOR_IDS_FILE", "neighbor_ids.npy")
+NEIGHBOR_SCORES_FILE = os.getenv("NEIGHBOR_SCORES_FILE", "neighbor_scores.npy")
+NEIGHBOR_MANIFEST_FILE = os.getenv("NEIGHBOR_MANIFEST_FILE", "neighbor_table_manifest.json")
+
+# number of precomputed neighbors per item and rows searched per FAISS call
+NEIGHBOR_TOP_N = int(os.getenv("NEIGHBOR_TOP_N", 50))
+NEIGHBOR_BATCH_SIZE = int(os.getenv("NEIGHBOR_BATCH_SIZE", 4096))
+
+s3 = boto3.client("s3", region_name=REGION)
+
+
+def drop_self_matches(indices, scores, row_ids):
+    """Removes each row's own id from its neighbor list, keeping top_n columns.
+
+    Searches are run with top_n + 1 results; when an item's own id is not among
+    them (e.g. duplicate vectors), the last column is dropped instead.
+    """
+    top_n = indices.shape[1] - 1
+    self_mask = indices == row_ids[:, None]
+    drop_col = np.where(self_mask.any(axis=1), self_mask.argmax(axis=1), top_n)
+    keep = np.ones(indices.shape, dtype=bool)
+    keep[np.arange(len(row_ids)), drop_col] = False
+    return indices[keep].reshape(-1, top_n), scores[keep].reshape(-1, top_n)
+
+
+def compute_neighbor_table(index, top_n=NEIGHBOR_TOP_N, batch_size=NEIGHBOR_BATCH_SIZE, item_vectors=None, rerank_factor=1, label_to_row=None):
+    """Runs a batched self-search over the whole index.
+
+    Queries come from item_vectors when given (required for indexes that
+    cannot reconstruct, e.g. IVF-PQ or ID-mapped indexes), otherwise from the
+    index itself. label_to_row translates item-ID labels to vector rows.
+    Returns an (ntotal x top_n) int32 matrix of index rows and a float16 matrix
+    of the matching FAISS distances. Missing neighbors are marked with -1.
+    """
+    ntotal = item_vectors.shape[0] if item_vectors is not None else index.ntotal
+    top_n = min(top_n, max(ntotal - 1, 0))
+    logging.info("Computing top-%d neighbors for %d items.", top_n, ntotal)
+
+    neighbor_ids = np.full((ntotal, top_n), -1, dtype=np.int32)
+    neighbor_scores = np.zeros((ntotal, top_n), dtype=np.float16)
+    if top_n == 0:
+        return neighbor_ids, neighbor_scores
+
+    for start in range(0, ntotal, batch_size):
+        stop = min(start + batch_size, ntotal)
+        if item_vectors is not None:
+            vectors = np.ascontiguousarray(item_vectors[start:stop], dtype=np.float32)
+        else:
+            vectors = index.reconstruct_n(start, stop - start)
+        scores, indices = query_faiss.search_with_rerank(index, item_vectors, vectors, top_n + 1, rerank_factor, label_to_row=label_to_row)
+        indices, scores = drop_self_matches(indices, scores, np.arange(start, stop))
+        neighbor_ids[start:stop] = indices
+        neighbor_scores[start:stop] = scores
+        logging.info("Processed neighbors for rows %d-%d.", start, stop)
+
+    return neighbor_ids, neighbor_scores
+
+
+def save_array_to_s3(array, key):
+    """Uploads array as .npy; returns its ETag/VersionId pin for the neighbor manifest."""
+    logging.info("Saving array with shape %s to S3: %s", array.shape, key)
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    response = s3.put_object(Bucket=S3_BUCKET, Key=key, Body=buffer.getvalue())
+    logging.info("Array saved to s3://%s/%s", S3_BUCKET, key)
+    return artifact_bundle.object_pin(response)
+
+
+def save_neighbor_manifest(index_version, artifacts):
+    """Records the index version the table was built from; serving ignores tables built for another one."""
+    neighbor_manifest = {
+        "index_version": index_version,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "artifacts": artifacts,
+    }
+    s3.put_object(Bucket=S3_BUCKET, Key=NEIGHBOR_MANIFEST_FILE, Body=json.dumps(neighbor_manifest, indent=2).encode("utf-8"))
+    logging.info("Neighbor table manifest saved to s3://%s/%s (index version %s)", S3_BUCKET, NEIGHBOR_MANIFEST_FILE, index_version)
+
+
+def main():
+    logging.info("Starting neighbor table build.")
+    manifest = query_faiss.load_manifest()
+    settings = manifest or {}
+    index = query_faiss.apply_search_params(query_faiss.load_faiss_index(manifest), settings.get("search_params"))
+    item_ids, bundle_vectors = query_faiss.load_item_bundle(manifest)
+    item_vectors = query_faiss.load_item_vectors(index, bundle_vectors)
+    label_to_row = None
+    if settings.get("index_labels") == "itemid":
+        label_to_row = query_faiss.load_itemid_map(item_ids).to_rows
+
+    neighbor_ids, neighbor_scores = compute_neighbor_table(
+        index, item_vectors=item_vectors, rerank_factor=settings.get("rerank_factor", 1), label_to_row=label_to_row
+    )
+
+    # a newer index published during the build makes this table stale; don't replace a fresher one
+    current = query_faiss.load_manifest()
+    if manifest is not None and (current or {}).get("version") != manifest["version"]:
+        logging.warning("Index version changed from %s to %s during the build, discarding the neighbor table.",
+                        manifest["version"], (current or {}).get("version"))
+        return
+    artifacts = {
+        NEIGHBOR_IDS_FILE: save_array_to_s3(neighbor_ids, NEIGHBOR_IDS_FILE),
+        NEIGHBOR_SCORES_FILE: save_array_to_s3(neighbor_scores, NEIGHBOR_SCORES_FILE),
+    }
+    if manifest is not None:
+        save_neighbor_manifest(manifest["version"], artifacts)
+    logging.info("Neighbor table build complete.")
+
+
+def build_neighbor_table():
+    """Main function to precompute the item-to-item neighbor table."""
+    try:
+        main()
+    except Exception as e:
+        logging.error("Error during neighbor table build: %s", e, exc_info=True)
+        raise
+
+
+if __name__ == "__main__":
+    build_neighbor_table()
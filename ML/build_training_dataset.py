@@ -2,11 +2,25 @@ import pandas as pd
 import boto3
 import os
 import io
+import re
 import json
 import logging
 from decimal import Decimal
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import time
-from botocore.exceptions import EndpointConnectionError
+import random
+import uuid
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from botocore.exceptions import ClientError, EndpointConnectionError
+from ML.event_batches import iter_batch_events, is_batch_key, to_table_item
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -15,6 +29,58 @@ BUCKET_NAME = os.getenv("S3_BUCKET", "ecom-raw-events")
 TABLE_NAME = os.getenv("DYNAMODB_TABLE", "user_interactions")
 OUTPUT_PREFIX = os.getenv("TRAINING_PREFIX", "train")
 
+# parallel scan: the table is split into SCAN_SEGMENTS segments read by SCAN_WORKERS threads
+SCAN_SEGMENTS = int(os.getenv("SCAN_SEGMENTS", 8))
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", SCAN_SEGMENTS))
+# per-segment resume tokens; an interrupted export continues where each segment stopped
+SCAN_STATE_PREFIX = os.getenv("SCAN_STATE_PREFIX", f"{OUTPUT_PREFIX}/_scan_state")
+RESUME_EXPORT = os.getenv("RESUME_EXPORT", "true").lower() == "true"
+# backoff on throttling, in seconds
+SCAN_BACKOFF_BASE = float(os.getenv("SCAN_BACKOFF_BASE", 0.5))
+SCAN_BACKOFF_MAX = float(os.getenv("SCAN_BACKOFF_MAX", 20))
+# scan -> encode -> upload pipeline: parquet encoding and S3 uploads run on their own pools,
+# and at most MAX_PENDING_PARTS scanned parts are held in memory at once
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", 4))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 8))
+MAX_PENDING_PARTS = int(os.getenv("MAX_PENDING_PARTS", 2 * ENCODE_WORKERS))
+UPLOAD_PART_SIZE_MB = int(os.getenv("UPLOAD_PART_SIZE_MB", 16))
+# merge each export's part files into one file per date partition once it finishes; a second pass
+# over the export (staged on local disk, one row group in memory at a time), so it is off by default
+MERGE_EXPORT_PARTITIONS = os.getenv("MERGE_EXPORT_PARTITIONS", "false").lower() == "true"
+# "full" exports the whole table, "incremental" only events newer than the saved watermark
+EXPORT_MODE = os.getenv("EXPORT_MODE", "full")
+# re-export this many seconds before the watermark to pick up late-arriving events
+WATERMARK_LAG_SECONDS = float(os.getenv("WATERMARK_LAG_SECONDS", 0))
+# GSI keyed by event_date (partition) and event_timestamp (sort); incremental exports Query it one
+# day at a time so reads scale with new events. Without it they Scan with a filter, which still
+# reads (and is billed for) the whole table and only saves the parquet written.
+INCREMENTAL_INDEX = os.getenv("INCREMENTAL_INDEX")
+# "dynamodb" scans the events table, "s3" compacts the raw event batches under RAW_EVENTS_PREFIX instead
+TRAINING_SOURCE = os.getenv("TRAINING_SOURCE", "dynamodb")
+RAW_EVENTS_PREFIX = os.getenv("EXPORT_PREFIX", "batches")
+# raw batches are compacted COMPACT_OBJECTS_PER_PART objects per parquet part, COMPACT_WORKERS parts at a time
+COMPACT_WORKERS = int(os.getenv("COMPACT_WORKERS", 8))
+COMPACT_OBJECTS_PER_PART = int(os.getenv("COMPACT_OBJECTS_PER_PART", 25))
+# one marker per compacted source object, named after its key
+COMPACTED_PREFIX = f"{SCAN_STATE_PREFIX}/compacted"
+# the running compaction: export id and the source keys of every part, written before any upload
+COMPACTION_JOURNAL_KEY = f"{SCAN_STATE_PREFIX}/compaction.json"
+# explicit Arrow types for the known event attributes; other (item property) columns are inferred per batch
+EVENT_FIELDS = {
+    "event_id": pa.string(),
+    "user_id": pa.string(),
+    "visitorid": pa.int64(),
+    "itemid": pa.int64(),
+    "item_id": pa.string(),
+    "event": pa.string(),
+    "event_timestamp": pa.string(),
+    "item_timestamp": pa.string(),
+    "transactionid": pa.string(),
+    "property": pa.string(),
+    "value": pa.string(),
+}
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+
 logging.info(f"Using region: {REGION}")
 logging.info(f"Table name: {TABLE_NAME}")
 
@@ -22,89 +88,642 @@ logging.info(f"Table name: {TABLE_NAME}")
 s3 = boto3.client('s3', region_name=REGION)
 dynamodb = boto3.resource('dynamodb', region_name=REGION)
 table = dynamodb.Table(TABLE_NAME)
+serializer = TypeSerializer()
+transfer_config = TransferConfig(
+    multipart_threshold=UPLOAD_PART_SIZE_MB * 1024 * 1024,
+    multipart_chunksize=UPLOAD_PART_SIZE_MB * 1024 * 1024,
+)
+deserializer = TypeDeserializer()
 
-# Convert DynamoDB items to DataFrame
-def convert_items_to_dataframe(items):
-    logging.info("Converting DynamoDB items to DataFrame...")
-
-    def convert_value(value):
-        if isinstance(value, Decimal):
-            return float(value)
-        elif isinstance(value, list):
-            return [convert_value(v) for v in value]
-        elif isinstance(value, dict):
-            return {k: convert_value(v) for k, v in value.items()}
-        else:
-            return value
+# Collect DynamoDB items column by column and convert them to Arrow
+class ColumnBuffer:
+    """Accumulates scanned items as sparse columns: per attribute, the row numbers and values.
+
+    Items rarely share every attribute (item properties vary), so nothing is
+    stored for missing attributes until to_record_batch() builds dense,
+    typed Arrow columns.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
 
-    cleaned = [{k: convert_value(v) for k, v in item.items()} for item in items]
-    df = pd.DataFrame(cleaned)
+    def extend(self, items):
+        for item in items:
+            for name, value in item.items():
+                if value is None:
+                    continue
+                rows, values = self.columns.setdefault(name, ([], []))
+                rows.append(self.num_rows)
+                values.append(value)
+            self.num_rows += 1
 
-    # Fix transactionid column
-    if "transactionid" in df.columns:
-        df["transactionid"] = df["transactionid"].astype(str).fillna("")
+    def to_record_batch(self):
+        """Builds a RecordBatch with EVENT_FIELDS types for known columns and inferred ones for the rest."""
+        names = [name for name in EVENT_FIELDS if name in self.columns]
+        names += sorted(name for name in self.columns if name not in EVENT_FIELDS)
+        fields, arrays = [], []
+        for name in names:
+            rows, values = self.columns[name]
+            arrow_type = EVENT_FIELDS.get(name) or infer_arrow_type(values)
+            fields.append(pa.field(name, arrow_type))
+            arrays.append(to_arrow_column(np.asarray(rows, dtype=np.int64), values, self.num_rows, arrow_type))
+        return pa.RecordBatch.from_arrays(arrays, schema=pa.schema(fields))
 
-    logging.info(f"Converted to DataFrame with shape {df.shape}.")
-    return df
+def infer_arrow_type(values):
+    """float64 for all-numeric columns, bool for all-boolean, string otherwise."""
+    kinds = {type(value) for value in values}
+    if kinds <= {Decimal, int, float}:
+        return pa.float64()
+    if kinds == {bool}:
+        return pa.bool_()
+    return pa.string()
 
+def to_text(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict, set)):
+        return json.dumps(value if not isinstance(value, set) else sorted(value, key=str), default=str)
+    return str(value)
 
-# Save DataFrame to S3 as Parquet
-def save_to_parquet(df, batch_index):
+def to_arrow_column(rows, values, num_rows, arrow_type):
+    """Dense Arrow array of num_rows with values at rows and nulls elsewhere.
+
+    Numeric columns are converted in one NumPy call (Decimal -> float64 or
+    int64); values that are not numbers become nulls.
+    """
+    missing = np.ones(num_rows, dtype=bool)
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_boolean(arrow_type):
+        dtype = arrow_type.to_pandas_dtype()
+        try:
+            converted = np.array(values, dtype=dtype)
+            valid = np.ones(len(values), dtype=bool)
+        except (TypeError, ValueError, ArithmeticError):
+            numbers = pd.to_numeric(pd.Series([to_text(value) for value in values], dtype=object), errors="coerce")
+            valid = numbers.notna().to_numpy()
+            converted = numbers.fillna(0).to_numpy().astype(dtype)
+        dense = np.zeros(num_rows, dtype=dtype)
+        dense[rows] = converted
+        missing[rows[valid]] = False
+        return pa.array(dense, type=arrow_type, mask=missing)
+    dense = np.full(num_rows, None, dtype=object)
+    dense[rows] = [to_text(value) for value in values]
+    return pa.array(dense, type=arrow_type)
+
+# Encode Arrow tables as Parquet and upload them to S3
+def encode_parquet(table):
     buffer = io.BytesIO()
-    df.to_parquet(buffer, index=False)
-    buffer.seek(0)
-    filename = f"{OUTPUT_PREFIX}/train_ready_batch_{batch_index}_{pd.Timestamp.now().strftime('%Y%m%d%H%M%S')}.parquet"
-    s3.upload_fileobj(buffer, BUCKET_NAME, filename)
-    logging.info(f"Saved batch {batch_index} with shape {df.shape} to s3://{BUCKET_NAME}/{filename}")
-
-# DynamoDB scan with batching logic
-def scan_dynamodb_and_save_batches(batch_size=50000, scan_limit=2000):
-    logging.info("Starting DynamoDB scan in batches...")
-    buffer = []
-    count = 0
-    batch_index = 0
-    last_evaluated_key = None
+    pq.write_table(table, buffer)
+    return buffer.getvalue()
+
+def upload_bytes(payload, filename):
+    s3.upload_fileobj(io.BytesIO(payload), BUCKET_NAME, filename, Config=transfer_config)
+    logging.info(f"Uploaded {len(payload)} bytes to s3://{BUCKET_NAME}/{filename}")
+
+def list_keys(prefix):
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=f"{prefix.rstrip('/')}/"):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
+def delete_keys(keys):
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=BUCKET_NAME, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]})
+
+def part_filename(export_id, segment, part, event_date):
+    # the export id stays the last "_" field, which downstream readers sort on
+    return f"{OUTPUT_PREFIX}/event_date={event_date}/train_ready_batch_s{segment:03d}p{part:05d}_{export_id}.parquet"
+
+PART_FILE = re.compile(r"train_ready_batch_s(?P<segment>\d{3})p(?P<part>\d{5})_(?P<export_id>[^/]+)\.parquet$")
+
+def encode_partitioned(table, export_id, segment, part):
+    """Encodes one parquet file per event_timestamp date partition; returns [(filename, bytes)].
+
+    Rows whose timestamp does not start with a valid date go to the
+    "unknown" partition.
+    """
+    if "event_date" in table.column_names:
+        table = table.drop(["event_date"])  # the partition path carries it
+    if "event_timestamp" in table.column_names:
+        days = pc.utf8_slice_codeunits(table["event_timestamp"], 0, 10)
+        valid = pc.is_valid(pc.strptime(days, format="%Y-%m-%d", unit="s", error_is_null=True))
+        dates = pc.if_else(pc.fill_null(valid, False), days, "unknown")
+    else:
+        dates = pa.array(["unknown"] * table.num_rows, type=pa.string())
+    return [
+        (part_filename(export_id, segment, part, event_date), encode_parquet(table.filter(pc.equal(dates, event_date))))
+        for event_date in sorted(pc.unique(dates).to_pylist())
+    ]
+
+# Merge an export's per-part files into one file per date partition
+def merged_filename(partition, export_id):
+    return f"{partition}/train_ready_batch_merged_{export_id}.parquet"
+
+def merged_schema(schemas):
+    """Union of the part schemas; columns typed differently across parts become strings."""
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, set()).add(field.type)
+    fields = []
+    for name, kinds in types.items():
+        # an inferred item property column can be numeric in one part and text in another
+        kinds = kinds - {pa.null()} or {pa.null()}
+        fields.append(pa.field(name, kinds.pop() if len(kinds) == 1 else pa.string()))
+    return pa.schema(fields)
+
+def conform(table, schema):
+    """table with schema's columns, in order: missing ones as nulls, mistyped ones cast."""
+    return pa.Table.from_arrays([
+        table[field.name].cast(field.type) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ], schema=schema)
+
+def merge_partition(partition, keys, export_id):
+    """Replaces an export's part files in one partition with a single merged file.
+
+    The parts are staged on local disk and streamed into one ParquetWriter a
+    row group at a time, so memory stays bounded by the largest part. Safe to
+    rerun: once the merged file exists, only the leftover part files are
+    deleted, since they are already in it.
+    """
+    merged = merged_filename(partition, export_id)
+    parts = sorted(key for key in keys if key != merged)
+    if merged not in keys:
+        if len(parts) <= 1:
+            return
+        with tempfile.TemporaryDirectory(prefix="merge-") as work_dir:
+            paths = [os.path.join(work_dir, f"part_{n:05d}.parquet") for n in range(len(parts))]
+            for key, path in zip(parts, paths):
+                s3.download_file(BUCKET_NAME, key, path, Config=transfer_config)
+            schema = merged_schema([pq.read_schema(path) for path in paths])
+            output = os.path.join(work_dir, "merged.parquet")
+            with pq.ParquetWriter(output, schema) as writer:
+                for path in paths:
+                    part = pq.ParquetFile(path)
+                    for row_group in range(part.num_row_groups):
+                        writer.write_table(conform(part.read_row_group(row_group), schema))
+            s3.upload_file(output, BUCKET_NAME, merged, Config=transfer_config)
+    delete_keys(parts)
+    logging.info(f"Merged {len(parts)} files into {merged}.")
+
+def merge_export_partitions(export_id, workers=UPLOAD_WORKERS):
+    """Merges the files an export wrote, so each date partition gets one file per export, not one per part."""
+    partitions = {}
+    for key in list_keys(OUTPUT_PREFIX):
+        if "/event_date=" in key and key.endswith(f"_{export_id}.parquet"):
+            partitions.setdefault(key.rsplit("/", 1)[0], []).append(key)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="merge") as executor:
+        list(executor.map(lambda item: merge_partition(item[0], item[1], export_id), partitions.items()))
+    logging.info(f"Merged export {export_id} across {len(partitions)} date partitions.")
+
+# Resume state, kept as small JSON objects next to the output
+def read_json(key):
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+def write_json(key, data):
+    s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=json.dumps(data).encode("utf-8"))
+
+def segment_state_key(segment):
+    return f"{SCAN_STATE_PREFIX}/segment_{segment:03d}.json"
+
+def serialize_key(key):
+    """LastEvaluatedKey -> JSON-safe DynamoDB wire format (keeps number vs string types)."""
+    return {name: serializer.serialize(value) for name, value in key.items()} if key else None
+
+def deserialize_key(key):
+    return {name: deserializer.deserialize(value) for name, value in key.items()} if key else None
+
+def watermark_key():
+    return f"{SCAN_STATE_PREFIX}/watermark.json"
+
+# Event times: event_timestamp is free text (e.g. "INVALID_TIMESTAMP"), so it is parsed before any comparison
+def parse_event_time(value):
+    """Naive pd.Timestamp for an ISO event_timestamp (offsets converted to UTC); None if it does not parse."""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = pd.Timestamp(value)
+    except ValueError:
+        return None
+    if parsed is pd.NaT:
+        return None
+    return parsed.tz_convert("UTC").tz_localize(None) if parsed.tzinfo is not None else parsed
+
+def newest_event_time(values):
+    """ISO string of the latest parseable timestamp in values, None if none parses."""
+    times = pd.to_datetime(pd.Series(values, dtype=object), errors="coerce", format="ISO8601", utc=True)
+    newest = times.max()
+    return None if pd.isna(newest) else newest.tz_localize(None).isoformat()
+
+def latest_event_time(*values):
+    """ISO string of the latest of values, ignoring missing and unparseable ones."""
+    times = [time for time in map(parse_event_time, values) if time is not None]
+    return max(times).isoformat() if times else None
+
+def read_watermark():
+    """The saved watermark as a pd.Timestamp, None if there is none; rejects one that does not parse."""
+    watermark = read_json(watermark_key())
+    if not watermark:
+        return None
+    since = parse_event_time(watermark.get("event_timestamp"))
+    if since is None:
+        raise ValueError(
+            f"Watermark s3://{BUCKET_NAME}/{watermark_key()} holds {watermark.get('event_timestamp')!r}, "
+            "which is not a timestamp; delete it to export the full table again."
+        )
+    return since
+
+def export_since(mode):
+    """Lower event_timestamp bound of an incremental export, None for a full one."""
+    if mode != "incremental":
+        return None
+    since = read_watermark()
+    if since is None:
+        logging.info("No watermark saved yet, exporting the full table.")
+        return None
+    return (since - pd.Timedelta(seconds=WATERMARK_LAG_SECONDS)).isoformat()
+
+def new_export_id():
+    # unique even for back-to-back runs, and still sorts by start time
+    return f"{pd.Timestamp.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+def incremental_buckets(since):
+    """event_date buckets an incremental Query reads: the day before since (for UTC offsets) through tomorrow."""
+    first = pd.Timestamp(since).normalize() - pd.Timedelta(days=1)
+    last = pd.Timestamp.now().normalize() + pd.Timedelta(days=1)
+    return [day.strftime("%Y-%m-%d") for day in pd.date_range(first, last)]
+
+def delete_uncommitted_parts(export_id):
+    """Deletes part files a crashed run uploaded after each segment's last committed part.
+
+    A resumed segment rescans from its committed LastEvaluatedKey, and with
+    the adaptive page limit its new parts split differently, so those files
+    would otherwise duplicate rows under other part numbers.
+    """
+    committed = {}
+    stale = []
+    for key in list_keys(OUTPUT_PREFIX):
+        match = PART_FILE.search(key)
+        if not match or match["export_id"] != export_id:
+            continue
+        segment = int(match["segment"])
+        if segment not in committed:
+            state = read_json(segment_state_key(segment))
+            committed[segment] = state["part"] if state and state.get("export_id") == export_id else 0
+        if int(match["part"]) >= committed[segment]:
+            stale.append(key)
+    if stale:
+        delete_keys(stale)
+        logging.warning(f"Deleted {len(stale)} part files of export {export_id} that were uploaded but never committed.")
+
+def start_export(total_segments, resume, mode=EXPORT_MODE):
+    """Returns the export settings, resuming an unfinished export with the same segment count.
+
+    An incremental export with INCREMENTAL_INDEX set reads one segment per
+    event_date bucket with Query instead of scanning total_segments segments.
+    """
+    export_key = f"{SCAN_STATE_PREFIX}/export.json"
+    export = read_json(export_key) if resume else None
+    if export and not export.get("done") and (export.get("buckets") or export.get("total_segments") == total_segments):
+        logging.info(f"Resuming export {export['export_id']}.")
+        delete_uncommitted_parts(export["export_id"])
+        return export
+    since = export_since(mode)
+    buckets = incremental_buckets(since) if since and INCREMENTAL_INDEX else None
+    if since and not buckets:
+        logging.warning("INCREMENTAL_INDEX is not set: the incremental export scans and is billed for the whole table.")
+    export = {
+        "export_id": new_export_id(),
+        "total_segments": len(buckets) if buckets else total_segments,
+        "since": since,
+        "index": INCREMENTAL_INDEX if buckets else None,
+        "buckets": buckets,
+        "done": False,
+    }
+    write_json(export_key, export)
+    logging.info(f"Starting export {export['export_id']} with {export['total_segments']} "
+                 f"{'event_date buckets' if buckets else 'segments'} (events after {since or 'the beginning of the table'}).")
+    return export
+
+def finish_export(export, states):
+    """Marks the export done and advances the watermark to the newest exported event.
+
+    Only timestamps that parse count, so an event stamped e.g.
+    "INVALID_TIMESTAMP" can never become the watermark.
+    """
+    previous = read_watermark()
+    newest = latest_event_time(*(state.get("max_event_timestamp") for state in states))
+    if newest and (previous is None or pd.Timestamp(newest) > previous):
+        write_json(watermark_key(), {"event_timestamp": newest, "export_id": export["export_id"]})
+        logging.info(f"Watermark advanced to {newest}.")
+    write_json(f"{SCAN_STATE_PREFIX}/export.json", dict(export, done=True, count=sum(state["count"] for state in states)))
 
+def page_request(segment, export):
+    """The table method and arguments that read one segment of the export."""
+    since = export.get("since")
+    if export.get("buckets"):
+        condition = Key("event_date").eq(export["buckets"][segment])
+        if since:
+            condition = condition & Key("event_timestamp").gt(since)
+        return "query", {"IndexName": export["index"], "KeyConditionExpression": condition}
+    kwargs = {"Segment": segment, "TotalSegments": export["total_segments"]}
+    if since:
+        # a string comparison: free text such as "INVALID_TIMESTAMP" sorts above every ISO date, so the
+        # upper bound (":" follows the digits) keeps values that cannot be timestamps out of incremental runs
+        kwargs["FilterExpression"] = Attr("event_timestamp").gt(since) & Attr("event_timestamp").lt(":")
+    return "scan", kwargs
+
+def read_page(segment_table, segment, export, page_limit, max_limit, start_key):
+    """One Scan (or bucket Query) call with exponential backoff on throttling and connection errors.
+
+    Returns the response and the page limit to use next: halved after
+    throttling, grown back towards the configured limit once calls succeed.
+    """
+    operation, kwargs = page_request(segment, export)
+    attempt = 0
     while True:
         try:
-            if last_evaluated_key:
-                response = table.scan(Limit=scan_limit, ExclusiveStartKey=last_evaluated_key)
+            if start_key:
+                response = getattr(segment_table, operation)(Limit=page_limit, ExclusiveStartKey=start_key, **kwargs)
             else:
-                response = table.scan(Limit=scan_limit)
-        except EndpointConnectionError as e:
-            logging.warning(f"Endpoint connection error: {e}. Retrying in 2s...")
-            time.sleep(2)
-            continue
+                response = getattr(segment_table, operation)(Limit=page_limit, **kwargs)
+            return response, min(max_limit, page_limit * 2)
+        except (ClientError, EndpointConnectionError) as e:
+            if isinstance(e, ClientError) and e.response["Error"]["Code"] not in THROTTLING_ERRORS:
+                raise
+            page_limit = max(1, page_limit // 2)
+            delay = min(SCAN_BACKOFF_MAX, SCAN_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+            attempt += 1
+            logging.warning(f"Segment {segment}: {e}. Retrying in {delay:.1f}s with Limit={page_limit}...")
+            time.sleep(delay)
+
+class SegmentProgress:
+    """Commits a segment's resume state as its parts finish uploading.
+
+    Parts are encoded and uploaded out of order, but the saved
+    LastEvaluatedKey only ever moves past a part once it and every earlier
+    part of the segment are in S3, so resuming never skips items.
+    """
 
-        items = response.get("Items", [])
-        buffer.extend(items)
-        count += len(items)
+    def __init__(self, segment, state):
+        self.segment = segment
+        self.state = state
+        self.pending = {}
+        self.error = None
+        self._cond = threading.Condition()
 
-        logging.info(f"Scanned total {count} items so far (buffered: {len(buffer)})")
+    def add_part(self, part, count, last_evaluated_key, done):
+        with self._cond:
+            self.pending[part] = {"count": count, "last_evaluated_key": last_evaluated_key, "done": done,
+                                  "remaining": None, "max_event_timestamp": None}
 
-        # When we accumulate a full batch
-        if len(buffer) >= batch_size:
-            df = convert_items_to_dataframe(buffer[:batch_size])
-            save_to_parquet(df, batch_index)
-            buffer = buffer[batch_size:]
-            batch_index += 1
+    def part_encoded(self, part, num_files, max_event_timestamp):
+        with self._cond:
+            self.pending[part].update(remaining=num_files, max_event_timestamp=max_event_timestamp)
+            self._commit()
 
+    def file_uploaded(self, part):
+        with self._cond:
+            self.pending[part]["remaining"] -= 1
+            self._commit()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = self.error or error
+            self._cond.notify_all()
+
+    def _commit(self):
+        committed = False
+        while self.pending.get(self.state["part"], {}).get("remaining") == 0:
+            part = self.pending.pop(self.state["part"])
+            self.state["part"] += 1
+            self.state["count"] += part["count"]
+            self.state["last_evaluated_key"] = part["last_evaluated_key"]
+            self.state["done"] = part["done"]
+            self.state["max_event_timestamp"] = latest_event_time(part["max_event_timestamp"], self.state["max_event_timestamp"])
+            committed = True
+        if committed:
+            write_json(segment_state_key(self.segment), self.state)
+            logging.info(f"Segment {self.segment}: {self.state['count']} items in {self.state['part']} parts committed.")
+            self._cond.notify_all()
+
+    def raise_if_failed(self):
+        if self.error is not None:
+            raise self.error
+
+    def wait(self):
+        """Blocks until every submitted part is committed; returns the final state."""
+        with self._cond:
+            while self.pending and self.error is None:
+                self._cond.wait()
+        self.raise_if_failed()
+        return self.state
+
+class ExportPipeline:
+    """Bounded scan -> encode -> upload pipeline shared by all segment scanners.
+
+    Scanners hand over full buffers and go back to scanning; they only block
+    when MAX_PENDING_PARTS parts are already being encoded or uploaded,
+    which caps memory at roughly that many batches.
+    """
+
+    def __init__(self, export_id, encode_workers=ENCODE_WORKERS, upload_workers=UPLOAD_WORKERS, max_pending_parts=MAX_PENDING_PARTS):
+        self.export_id = export_id
+        self.encoders = ThreadPoolExecutor(max_workers=max(1, encode_workers), thread_name_prefix="encode")
+        self.uploaders = ThreadPoolExecutor(max_workers=max(1, upload_workers), thread_name_prefix="upload")
+        self.slots = threading.BoundedSemaphore(max(1, max_pending_parts))
+
+    def submit(self, progress, part, buffer, last_evaluated_key, done):
+        progress.add_part(part, len(buffer), serialize_key(last_evaluated_key), done)
+        self.slots.acquire()
+        self.encoders.submit(self._encode, progress, part, buffer)
+
+    def _encode(self, progress, part, buffer):
+        try:
+            table = pa.Table.from_batches([buffer.to_record_batch()])
+            newest = newest_event_time(table["event_timestamp"].to_pylist()) if "event_timestamp" in table.column_names else None
+            files = encode_partitioned(table, self.export_id, progress.segment, part)
+        except Exception as e:
+            self.slots.release()
+            progress.fail(e)
+            return
+        # the slot is held until the part's last file is uploaded
+        remaining = [len(files)]
+        lock = threading.Lock()
+
+        def uploaded(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.slots.release()
+            if future.exception() is not None:
+                progress.fail(future.exception())
+            else:
+                progress.file_uploaded(part)
+
+        progress.part_encoded(part, len(files), newest)
+        if not files:
+            self.slots.release()
+        for filename, payload in files:
+            self.uploaders.submit(upload_bytes, payload, filename).add_done_callback(uploaded)
+
+    def close(self):
+        self.encoders.shutdown(wait=True)
+        self.uploaders.shutdown(wait=True)
+
+def scan_segment(segment, export, pipeline, batch_size, scan_limit, resume):
+    """Scans one segment, handing a part to the pipeline whenever batch_size items are buffered.
+
+    Parts are cut at page boundaries and the segment's LastEvaluatedKey is
+    committed once a part is uploaded, so a resumed segment neither skips nor
+    repeats items that were already written. Returns the final segment state.
+    """
+    export_id = export["export_id"]
+    state = read_json(segment_state_key(segment)) if resume else None
+    if not state or state.get("export_id") != export_id:
+        state = {"export_id": export_id, "last_evaluated_key": None, "part": 0, "count": 0, "max_event_timestamp": None, "done": False}
+    if state["done"]:
+        logging.info(f"Segment {segment} already exported ({state['count']} items).")
+        return state
+
+    # boto3 resources are not thread-safe, so each segment gets its own
+    segment_table = boto3.resource('dynamodb', region_name=REGION).Table(TABLE_NAME)
+    progress = SegmentProgress(segment, state)
+    last_evaluated_key = deserialize_key(state["last_evaluated_key"])
+    next_part = state["part"]
+    page_limit = scan_limit
+    buffer = ColumnBuffer()
+    while True:
+        progress.raise_if_failed()
+        response, page_limit = read_page(segment_table, segment, export, page_limit, scan_limit, last_evaluated_key)
+        buffer.extend(response.get("Items", []))
         last_evaluated_key = response.get("LastEvaluatedKey")
+
+        if len(buffer) >= batch_size or not last_evaluated_key:
+            pipeline.submit(progress, next_part, buffer, last_evaluated_key, not last_evaluated_key)
+            next_part += 1
+            buffer = ColumnBuffer()
+            logging.info(f"Segment {segment}: submitted part {next_part - 1}.")
         if not last_evaluated_key:
-            break
+            return progress.wait()
 
-    # Save the remaining records
-    if buffer:
-        df = convert_items_to_dataframe(buffer)
-        save_to_parquet(df, batch_index)
-        logging.info("Final partial batch saved.")
+# Parallel DynamoDB scan feeding the encode/upload pipeline
+def scan_dynamodb_and_save_batches(batch_size=50000, scan_limit=2000, total_segments=SCAN_SEGMENTS, workers=SCAN_WORKERS, resume=RESUME_EXPORT, mode=EXPORT_MODE):
+    logging.info(f"Starting parallel DynamoDB scan ({mode}): {total_segments} segments, {workers} workers...")
+    export = start_export(total_segments, resume, mode)
+    pipeline = ExportPipeline(export["export_id"])
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scan") as executor:
+            states = list(executor.map(
+                lambda segment: scan_segment(segment, export, pipeline, batch_size, scan_limit, resume),
+                range(export["total_segments"]),
+            ))
+    finally:
+        pipeline.close()
+    if MERGE_EXPORT_PARTITIONS:
+        merge_export_partitions(export["export_id"])
+    finish_export(export, states)
+    logging.info(f"Total items exported: {sum(state['count'] for state in states)} across {export['total_segments']} segments.")
 
-    logging.info(f"Total items scanned: {count}, total batches saved: {batch_index + 1}")
+# Compact the raw S3 event batches straight into parquet, without touching DynamoDB
+def compacted_marker_key(source_key):
+    return f"{COMPACTED_PREFIX}/{source_key}.json"
+
+def pending_raw_batches():
+    """Raw batch keys that have no compaction marker yet, oldest first."""
+    done = {key[len(COMPACTED_PREFIX) + 1:-len(".json")] for key in list_keys(COMPACTED_PREFIX)}
+    return sorted(key for key in list_keys(RAW_EVENTS_PREFIX) if is_batch_key(key) and key not in done)
+
+def compact_raw_batches_part(export_id, part, keys):
+    """Streams the events of keys into one ColumnBuffer and uploads it as date-partitioned parquet.
+
+    File names depend only on the export id and part number, so rerunning a
+    part overwrites its files instead of adding a second copy of its events.
+    Events repeated within the part (duplicate deliveries) are kept once per
+    event_id, as DynamoDB keeps one item per key. Returns the number of
+    events kept from each key.
+    """
+    buffer = ColumnBuffer()
+    counts = {}
+    seen = set()
+
+    def first_delivery(item):
+        if item is None or item["event_id"] in seen:
+            return False
+        seen.add(item["event_id"])
+        return True
+
+    for key in keys:
+        before = len(buffer)
+        body = s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"]
+        buffer.extend(filter(first_delivery, map(to_table_item, iter_batch_events(body))))
+        counts[key] = len(buffer) - before
+    if len(buffer):
+        table = pa.Table.from_batches([buffer.to_record_batch()])
+        for filename, payload in encode_partitioned(table, export_id, 0, part):
+            upload_bytes(payload, filename)
+    logging.info(f"Compacted part {part}: {len(keys)} raw batches, {len(buffer)} events.")
+    return counts
+
+def run_compaction(journal, workers):
+    """Compacts, merges and marks the parts of a journaled run; safe to repeat after a failure.
+
+    The journal fixes the export id and each part's source keys before any
+    upload, so a repeated run rewrites the same files, and the optional
+    partition merge skips files it already merged. Markers are written only
+    once the files are in place.
+    """
+    export_id = journal["export_id"]
+    parts = journal["parts"]
+    logging.info(f"Compacting {sum(map(len, parts))} raw batches into {len(parts)} parts (export {export_id}, {workers} workers)...")
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="compact") as executor:
+        counts = list(executor.map(lambda args: compact_raw_batches_part(export_id, *args), enumerate(parts)))
+    if MERGE_EXPORT_PARTITIONS:
+        merge_export_partitions(export_id)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="mark") as executor:
+        list(executor.map(
+            lambda item: write_json(compacted_marker_key(item[0]), {"export_id": export_id, "part": item[1], "count": item[2]}),
+            [(key, part, part_counts[key]) for part, part_counts in enumerate(counts) for key in part_counts],
+        ))
+    write_json(COMPACTION_JOURNAL_KEY, dict(journal, done=True))
+    total = sum(sum(part_counts.values()) for part_counts in counts)
+    logging.info(f"Total events compacted: {total} from {sum(map(len, parts))} raw batches.")
+
+def compact_raw_batches(workers=COMPACT_WORKERS, objects_per_part=COMPACT_OBJECTS_PER_PART):
+    journal = read_json(COMPACTION_JOURNAL_KEY)
+    if journal and not journal.get("done"):
+        logging.info(f"Resuming unfinished compaction {journal['export_id']}.")
+        run_compaction(journal, workers)
+    keys = pending_raw_batches()
+    if not keys:
+        logging.info(f"No new raw batches under s3://{BUCKET_NAME}/{RAW_EVENTS_PREFIX}.")
+        return
+    journal = {
+        "export_id": new_export_id(),
+        "parts": [keys[start:start + objects_per_part] for start in range(0, len(keys), objects_per_part)],
+        "done": False,
+    }
+    write_json(COMPACTION_JOURNAL_KEY, journal)
+    run_compaction(journal, workers)
 
 # Main function
 def build_training_dataset():
     try:
-        scan_dynamodb_and_save_batches()
+        if TRAINING_SOURCE == "s3":
+            compact_raw_batches()
+        else:
+            scan_dynamodb_and_save_batches()
         logging.info("Training dataset build completed successfully.")
     except Exception as e:
         logging.error(f"Error during training dataset build: {e}")
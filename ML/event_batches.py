@@ -0,0 +1,186 @@
+import io
+import re
+import gzip
+import json
+import codecs
+import hashlib
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+try:
+    import zstandard
+except ImportError:  # optional; batches are written with gzip instead
+    zstandard = None
+
+# raw event batches are read in chunks of this many bytes
+READ_CHUNK_SIZE = 1 << 20
+
+# batch formats by key suffix; readers detect the format from the content, not the name
+BATCH_SUFFIXES = {"json": ".json", "ndjson": ".ndjson", "gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_WHITESPACE = re.compile(r"\s*")
+_decoder = json.JSONDecoder(parse_float=Decimal)
+
+
+def iter_json_array(stream, chunk_size=READ_CHUNK_SIZE):
+    """Yields the elements of a top-level JSON array read incrementally from a binary stream.
+
+    Only the current chunk and the element being decoded are held in
+    memory. Floats are parsed as Decimal, as DynamoDB expects.
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+    while True:
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + text_decoder.decode(chunk or b"", final=eof)
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Event batch is not a JSON array.")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            if buffer[pos] == ",":
+                pos += 1
+                continue
+            try:
+                element, end = _decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break  # element continues in the next chunk
+            yield element
+            pos = end
+        if eof:
+            if started:
+                raise ValueError("Unterminated JSON array in event batch.")
+            return
+
+
+def iter_ndjson(stream):
+    """Yields one event per non-empty line of a binary NDJSON stream."""
+    for line in io.TextIOWrapper(stream, encoding="utf-8"):
+        if line.strip():
+            yield _decoder.decode(line)
+
+
+class _RawStream(io.RawIOBase):
+    """Adapts any object with read(n) (e.g. an S3 StreamingBody) to io.BufferedReader."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def buffered(stream):
+    return io.BufferedReader(_RawStream(stream), READ_CHUNK_SIZE)
+
+
+def decompressed(stream):
+    """Buffered binary stream over stream, transparently decompressing gzip or zstd."""
+    stream = buffered(stream)
+    head = stream.peek(len(ZSTD_MAGIC))
+    if head.startswith(GZIP_MAGIC):
+        return buffered(gzip.GzipFile(fileobj=stream))
+    if head.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Event batch is zstd-compressed but the zstandard package is not installed.")
+        return buffered(zstandard.ZstdDecompressor().stream_reader(stream))
+    return stream
+
+
+def iter_batch_events(stream):
+    """Yields the events of one raw event batch from a binary stream.
+
+    Accepts the legacy JSON array as well as NDJSON, plain or gzip/zstd
+    compressed; the format is detected from the leading bytes.
+    """
+    stream = decompressed(stream)
+    if stream.peek(READ_CHUNK_SIZE).lstrip()[:1] == b"[":
+        yield from iter_json_array(stream)
+    else:
+        yield from iter_ndjson(stream)
+
+
+def is_batch_key(key):
+    return key.endswith(tuple(BATCH_SUFFIXES.values()))
+
+
+def default_compression():
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def encode_batch(events, compression="auto"):
+    """Serializes events as NDJSON in memory; returns (payload, key suffix).
+
+    compression is "zstd", "gzip", "none" or "auto" (zstd when the optional
+    zstandard package is installed, gzip otherwise).
+    """
+    if compression == "auto":
+        compression = default_compression()
+    if compression == "zstd" and zstandard is None:
+        compression = "gzip"
+    buffer = io.BytesIO()
+    if compression == "zstd":
+        writer = zstandard.ZstdCompressor().stream_writer(buffer, closefd=False)
+    elif compression == "gzip":
+        writer = gzip.GzipFile(fileobj=buffer, mode="wb")
+    else:
+        writer, compression = buffer, "ndjson"
+    for event in events:
+        writer.write(json.dumps(event, separators=(",", ":")).encode("utf-8"))
+        writer.write(b"\n")
+    if writer is not buffer:
+        writer.close()
+    return buffer.getvalue(), BATCH_SUFFIXES[compression]
+
+
+def event_id_for(event):
+    """Deterministic event ID derived from the event's content.
+
+    Re-importing the same batch yields the same IDs, so retries overwrite
+    instead of duplicating. Events must be parsed with floats as Decimal so
+    every reader hashes the same canonical form.
+    """
+    canonical = json.dumps(event, sort_keys=True, separators=(",", ":"), default=str)
+    return str(uuid.UUID(bytes=hashlib.sha256(canonical.encode("utf-8")).digest()[:16]))
+
+
+def event_date_of(timestamp):
+    """YYYY-MM-DD day of an ISO event_timestamp, "unknown" if it does not start with a valid date."""
+    try:
+        return datetime.strptime(str(timestamp)[:10], "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return "unknown"
+
+
+def to_table_item(event):
+    """Normalizes a raw event to the item stored in DynamoDB; None if it has no user_id."""
+    if "user_id" not in event:
+        return None
+    item = dict(event)
+    item["event_id"] = event_id_for(event)
+    item["user_id"] = str(item["user_id"])  # required for GSI
+    if "event_timestamp" in item:
+        item["event_timestamp"] = str(item["event_timestamp"])
+        item["event_date"] = event_date_of(item["event_timestamp"])  # partition key of the incremental export GSI
+    return item
@@ -1,116 +1,579 @@
 import os
 import io
+import re
 import boto3
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+from collections import Counter
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 from sklearn.preprocessing import MinMaxScaler
-from sklearn.decomposition import PCA
+from sklearn.decomposition import TruncatedSVD, IncrementalPCA
+from sklearn.random_projection import SparseRandomProjection
 import numpy as np
+import scipy.sparse as sp
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyarrow import fs
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from botocore.exceptions import ClientError
+import hashlib
 import pickle
+import shutil
 import logging
+from ML import artifact_bundle
 
 
 REGION = os.getenv("AWS_REGION", "us-east-1")
 S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
 EMBEDDING_PREFIX = os.getenv("EMBEDDING_PREFIX", "embeddings")
+# storage dtype of the published embedding matrix: float32 or float16
+EMBEDDING_BUNDLE_DTYPE = os.getenv("EMBEDDING_BUNDLE_DTYPE", "float32")
+# unpartitioned training files (older exports) and the event_date=YYYY-MM-DD partitions of newer ones
 ITEM_FEATURES_FILE = os.getenv("ITEM_FEATURES_FILE", "train/train_ready_batch_")
+ITEM_FEATURES_PARTITIONS = os.getenv("ITEM_FEATURES_PARTITIONS", f"{os.getenv('TRAINING_PREFIX', 'train')}/event_date=")
+# optional inclusive range of event_date=YYYY-MM-DD partitions to read; unpartitioned files are always read
+EVENT_DATE_FROM = os.getenv("EVENT_DATE_FROM")
+EVENT_DATE_TO = os.getenv("EVENT_DATE_TO")
 
 # hyperparameters
 TFIDF_MAX_FEATURES = int(os.getenv("TFIDF_MAX_FEATURES", 100))
 PCA_COMPONENTS = int(os.getenv("PCA_COMPONENTS", 64))
+# sparse-aware reducer: "svd" (TruncatedSVD, IncrementalPCA when streaming) or "random_projection"
+REDUCER = os.getenv("REDUCER", "svd")
+
+# "batch" holds all consolidated items in memory, "streaming" keeps memory bounded per file
+EMBEDDING_MODE = os.getenv("EMBEDDING_MODE", "batch")
+EMBEDDING_WORK_DIR = os.getenv("EMBEDDING_WORK_DIR", "/tmp/item_embeddings")
+# memory budget when streaming: items are merged in hash buckets of about this many items (the
+# bucket count follows from the row count), and densified EMBEDDING_CHUNK_ROWS rows at a time
+EMBEDDING_BUCKET_ROWS = int(os.getenv("EMBEDDING_BUCKET_ROWS", 100000))
+EMBEDDING_CHUNK_ROWS = int(os.getenv("EMBEDDING_CHUNK_ROWS", 10000))
+# parquet files downloaded ahead of the one being processed
+PREFETCH_FILES = int(os.getenv("PREFETCH_FILES", 4))
+
+# fitted TF-IDF/scaler/reducer and the content-hash -> vector cache built with them
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE", "embedding_model.pkl")
+EMBEDDING_CACHE_FILE = os.getenv("EMBEDDING_CACHE_FILE", "embedding_cache.npy")
+# the published model is reused (so cached vectors stay valid) unless a refit is forced
+EMBEDDING_REFIT = os.getenv("EMBEDDING_REFIT", "false").lower() == "true"
+
+# per-event columns that carry no item information
+EVENT_COLUMNS = ['user_id', 'visitorid', 'event', 'event_id', 'transactionid']
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 s3 = boto3.client('s3', region_name=REGION)
+# random-access S3 reads: parquet footers and only the needed column chunks are fetched
+s3_filesystem = fs.S3FileSystem(region=REGION)
+
 
+def partition_selected(key, date_from=EVENT_DATE_FROM, date_to=EVENT_DATE_TO):
+    match = re.search(r"event_date=([^/]+)/", key)
+    if match is None:
+        return True
+    event_date = match.group(1)
+    return (not date_from or event_date >= date_from) and (not date_to or event_date <= date_to)
+
+def iter_parquet_keys(prefixes=(ITEM_FEATURES_FILE, ITEM_FEATURES_PARTITIONS)):
+    """Yields the training dataset parquet keys under prefixes in the selected date partitions.
+
+    Follows list_objects_v2 pagination; a key under several prefixes is yielded once.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    seen = set()
+    for prefix in prefixes:
+        if not prefix:
+            continue
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                if key in seen or not key.endswith('.parquet') or not os.path.basename(key).startswith('train_ready_batch_'):
+                    continue
+                seen.add(key)
+                if partition_selected(key):
+                    yield key
 
 def list_parquet_files():
     logging.info("Listing parquet files in S3 bucket...")
-    response = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=ITEM_FEATURES_FILE)
-    files = [obj['Key'] for obj in response.get('Contents', []) if obj['Key'].endswith('.parquet')]
+    files = list(iter_parquet_keys())
     files.sort(key=lambda x: x.split('_')[-1])  # Sort by file suffix
     logging.info(f"Found {len(files)} parquet files.")
     return files
 
-def load_parquet_from_s3(key):
+def load_parquet_from_s3(key, filesystem=None):
+    """Reads only item columns and rows with an itemid.
+
+    The object is read with ranged requests: the footer first, then only
+    the column chunks of item columns. The itemid null filter is pushed down
+    to the parquet reader, which also skips row groups whose statistics show
+    no itemid at all.
+    """
     logging.info(f"Loading parquet file from S3: {key}")
-    response = s3.get_object(Bucket=S3_BUCKET, Key=key)
-    df = pd.read_parquet(io.BytesIO(response['Body'].read()))
+    with (filesystem or s3_filesystem).open_input_file(f"{S3_BUCKET}/{key}") as source:
+        columns = [name for name in pq.ParquetFile(source).schema_arrow.names if name not in EVENT_COLUMNS]
+        if 'itemid' not in columns:
+            logging.warning(f"No itemid column in {key}, skipping.")
+            return pd.DataFrame(columns=['itemid'])
+        table = pq.read_table(source, columns=columns, filters=pc.field('itemid').is_valid())
+    df = table.to_pandas()
     logging.info(f"Loaded {len(df)} rows from {key}.")
     return df
 
+def parquet_num_rows(key, filesystem=None):
+    with (filesystem or s3_filesystem).open_input_file(f"{S3_BUCKET}/{key}") as source:
+        return pq.ParquetFile(source).metadata.num_rows
+
+def count_parquet_rows(keys, workers=PREFETCH_FILES):
+    """Total rows of keys, read from their parquet footers only."""
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return sum(executor.map(parquet_num_rows, keys))
 
-def preprocess_features(df):
+def prefetch_parquet_files(keys, prefetch=PREFETCH_FILES):
+    """Yields (key, DataFrame) in order while the next files download on a thread pool."""
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        pending = deque()
+        for key in keys:
+            pending.append((key, executor.submit(load_parquet_from_s3, key)))
+            if len(pending) > prefetch:
+                done_key, future = pending.popleft()
+                yield done_key, future.result()
+        while pending:
+            done_key, future = pending.popleft()
+            yield done_key, future.result()
+
+
+def consolidate_items(df):
+    """Reduces event rows to one feature row per itemid.
+
+    Rows are ordered by event_timestamp and each column keeps its latest
+    non-null value, i.e. the latest known snapshot of every property.
+    Applying it again to already consolidated frames is safe, which is how
+    batches from several files are merged.
+    """
+    df = df.drop(columns=[col for col in EVENT_COLUMNS if col in df.columns])
+    df['itemid'] = pd.to_numeric(df['itemid'], errors='coerce')
+    df = df.dropna(subset=['itemid'])
+    df['itemid'] = df['itemid'].astype('int64').astype(str)
+    if 'event_timestamp' in df.columns:
+        order = pd.to_datetime(df['event_timestamp'], errors='coerce').argsort(kind='stable')
+        df = df.iloc[order]
+    consolidated = df.groupby('itemid', sort=False).last().reset_index()
+    logging.info(f"Consolidated {len(df)} rows into {len(consolidated)} unique items.")
+    return consolidated
+
+def preprocess_features(df, scaler=None, numeric_cols=None):
+    """Returns itemids, combined text and the min-max scaled numeric matrix.
+
+    A pre-fitted scaler and its numeric_cols can be passed so batches are
+    scaled consistently; columns missing from a batch are treated as 0.
+    """
     df = df.dropna(subset=['itemid']).copy()
     df['itemid'] = df['itemid'].astype(str)
-    text_cols = [col for col in df.columns if df[col].dtype == 'object' and col not in ['itemid', 'user_id', 'event', 'event_timestamp']]
+    # object columns, or the string dtype newer pandas infers for text
+    text_cols = [col for col in df.columns if (df[col].dtype == 'object' or isinstance(df[col].dtype, pd.StringDtype))
+                 and col not in ['itemid', 'user_id', 'event', 'event_timestamp']]
     df[text_cols] = df[text_cols].fillna('unknown').astype(str)
     df['combined_text'] = df[text_cols].agg(' '.join, axis=1)
-    numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
-    numeric_matrix = MinMaxScaler().fit_transform(df[numeric_cols]) if numeric_cols else None
+    if numeric_cols is None:
+        numeric_cols = df.select_dtypes(include=[np.number]).columns.tolist()
+    if not numeric_cols:
+        return df['itemid'].tolist(), df['combined_text'], None
+    numeric = df.reindex(columns=numeric_cols).astype(np.float64)
+    if scaler is None:
+        scaler = MinMaxScaler().fit(numeric)
+    numeric_matrix = np.nan_to_num(scaler.transform(numeric))
     return df['itemid'].tolist(), df['combined_text'], numeric_matrix
 
 def generate_embeddings(texts, numeric_matrix, tfidf_model=None):
+    """Builds the sparse (CSR, float32) feature matrix: TF-IDF terms plus scaled numeric columns."""
     if tfidf_model is None:
-        tfidf_model = TfidfVectorizer(max_features=TFIDF_MAX_FEATURES)
-        tfidf_matrix = tfidf_model.fit_transform(texts).toarray()
+        tfidf_model = TfidfVectorizer(max_features=TFIDF_MAX_FEATURES, dtype=np.float32)
+        tfidf_matrix = tfidf_model.fit_transform(texts)
     else:
-        tfidf_matrix = tfidf_model.transform(texts).toarray()
+        tfidf_matrix = tfidf_model.transform(texts)
 
     if numeric_matrix is not None:
-        full_matrix = np.hstack((tfidf_matrix, numeric_matrix))
+        full_matrix = sp.hstack((tfidf_matrix, sp.csr_matrix(numeric_matrix, dtype=np.float32)), format="csr")
     else:
-        full_matrix = tfidf_matrix
+        full_matrix = tfidf_matrix.tocsr()
 
     return full_matrix, tfidf_model
 
-def reduce_dimensionality(matrix):
-    if matrix.shape[1] > PCA_COMPONENTS:
-        pca = PCA(n_components=PCA_COMPONENTS)
-        return pca.fit_transform(matrix)
-    return matrix
+def make_reducer():
+    if REDUCER == "svd":
+        return TruncatedSVD(n_components=PCA_COMPONENTS, algorithm="randomized", random_state=0)
+    if REDUCER == "random_projection":
+        return SparseRandomProjection(n_components=PCA_COMPONENTS, dense_output=True, random_state=0)
+    raise ValueError(f"Unknown REDUCER: {REDUCER}")
 
-def save_embeddings_to_s3(itemids, vectors):
-    logging.info("Saving final embeddings to S3...")
+def reduce_features(reducer, matrix, chunk_rows=EMBEDDING_CHUNK_ROWS):
+    """Reduces the sparse feature matrix to dense float32 rows with a fitted reducer.
+
+    TruncatedSVD and random projection work on the CSR matrix directly;
+    IncrementalPCA (streaming fit), or no reducer, needs dense input, which
+    is built chunk_rows rows at a time.
+    """
+    if reducer is not None and not isinstance(reducer, IncrementalPCA):
+        return np.ascontiguousarray(reducer.transform(matrix), dtype=np.float32)
+    dim = reducer.n_components_ if reducer is not None else matrix.shape[1]
+    vectors = np.empty((matrix.shape[0], dim), dtype=np.float32)
+    for start in range(0, matrix.shape[0], max(1, chunk_rows)):
+        dense = matrix[start:start + chunk_rows].toarray()
+        vectors[start:start + dense.shape[0]] = dense if reducer is None else reducer.transform(dense)
+    return vectors
+
+def model_params():
+    return {"tfidf_max_features": TFIDF_MAX_FEATURES, "pca_components": PCA_COMPONENTS, "reducer": REDUCER}
+
+def make_embedding_model(tfidf_model, scaler, numeric_cols, reducer):
+    """Bundles the fitted components with a version derived from their contents."""
+    model = {
+        "tfidf": tfidf_model,
+        "scaler": scaler,
+        "numeric_cols": numeric_cols,
+        "reducer": reducer,
+        "dim": reducer.n_components if reducer is not None else len(tfidf_model.vocabulary_) + len(numeric_cols),
+        "params": model_params(),
+    }
+    model["version"] = hashlib.sha256(pickle.dumps(model)).hexdigest()[:16]
+    return model
+
+def fit_embedding_model(items):
+    """Fits TF-IDF, scaler and reducer on all consolidated items (batch mode)."""
+    numeric_cols = items.select_dtypes(include=[np.number]).columns.tolist()
+    scaler = MinMaxScaler().fit(items[numeric_cols].astype(np.float64)) if numeric_cols else None
+    _, texts, numeric_matrix = preprocess_features(items, scaler, numeric_cols)
+    full_matrix, tfidf_model = generate_embeddings(texts, numeric_matrix)
+    reducer = make_reducer().fit(full_matrix) if full_matrix.shape[1] > PCA_COMPONENTS else None
+    return make_embedding_model(tfidf_model, scaler, numeric_cols, reducer)
+
+def load_embedding_model():
+    """Returns the published model, or None if absent or fitted with other settings."""
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=EMBEDDING_MODEL_FILE)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            logging.info(f"No embedding model found at {EMBEDDING_MODEL_FILE}.")
+            return None
+        raise
+    model = pickle.loads(response['Body'].read())
+    if model["params"] != model_params():
+        logging.info(f"Embedding settings changed since model {model['version']} was fitted.")
+        return None
+    return model
+
+def save_embedding_model(model):
     buffer = io.BytesIO()
-    pickle.dump({"itemid": itemids, "vectors": vectors}, buffer)
+    pickle.dump(model, buffer)
     buffer.seek(0)
-    s3.upload_fileobj(buffer, S3_BUCKET, EMBEDDING_PREFIX)
+    s3.upload_fileobj(buffer, S3_BUCKET, EMBEDDING_MODEL_FILE)
+    logging.info(f"Saved embedding model {model['version']} to s3://{S3_BUCKET}/{EMBEDDING_MODEL_FILE}")
+
+def get_embedding_model(fit):
+    """Reuses the published model unless EMBEDDING_REFIT is set; otherwise fits and publishes one."""
+    model = None if EMBEDDING_REFIT else load_embedding_model()
+    if model is not None:
+        logging.info(f"Reusing embedding model {model['version']}.")
+        return model
+    model = fit()
+    save_embedding_model(model)
+    return model
+
+def content_keys(texts, numeric_matrix, version):
+    """64-bit hash per item of its normalized text, scaled numeric values and the model version.
+
+    Text is lowercased and whitespace-collapsed, which TF-IDF ignores anyway,
+    so the key changes exactly when the item's embedding would.
+    """
+    version = version.encode("utf-8")
+    keys = np.empty(len(texts), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        digest = hashlib.blake2b(" ".join(text.lower().split()).encode("utf-8"), digest_size=8, key=version)
+        if numeric_matrix is not None:
+            digest.update(numeric_matrix[i].tobytes())
+        keys[i] = int.from_bytes(digest.digest(), "little")
+    return keys
+
+def cache_dtype(dim):
+    return np.dtype([("key", np.uint64), ("vector", np.float32, (dim,))])
+
+def load_embedding_cache(dim):
+    """Downloads the embedding cache and memory-maps it; None if absent or of another dim.
+
+    The cache is a .npy record array sorted by key. Keys include the model
+    version, so entries from an older model simply never match.
+    """
+    os.makedirs(EMBEDDING_WORK_DIR, exist_ok=True)
+    path = os.path.join(EMBEDDING_WORK_DIR, "embedding_cache.npy")
+    try:
+        s3.download_file(S3_BUCKET, EMBEDDING_CACHE_FILE, path)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            logging.info(f"No embedding cache found at {EMBEDDING_CACHE_FILE}.")
+            return None
+        raise
+    cache = np.load(path, mmap_mode="r")
+    if cache.dtype != cache_dtype(dim):
+        logging.info("Embedding cache has a different layout, ignoring it.")
+        return None
+    logging.info(f"Loaded embedding cache with {len(cache)} entries.")
+    return cache
+
+def lookup_cached(cache, keys, out):
+    """Copies cached vectors for keys into out; returns the boolean hit mask."""
+    if cache is None or len(cache) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    cached_keys = cache["key"]
+    pos = np.minimum(np.searchsorted(cached_keys, keys), len(cached_keys) - 1)
+    hit = cached_keys[pos] == keys
+    out[hit] = cache["vector"][pos[hit]]
+    return hit
+
+def embed_items(items, model, cache):
+    """Embeds consolidated items, transforming only those missing from the cache.
+
+    Returns itemids, float32 vectors, content keys and the number of cache hits.
+    """
+    itemids, texts, numeric_matrix = preprocess_features(items, model["scaler"], model["numeric_cols"])
+    keys = content_keys(texts, numeric_matrix, model["version"])
+    vectors = np.empty((len(keys), model["dim"]), dtype=np.float32)
+    hit = lookup_cached(cache, keys, vectors)
+    miss = ~hit
+    if miss.any():
+        full_matrix, _ = generate_embeddings(
+            texts[miss], numeric_matrix[miss] if numeric_matrix is not None else None, model["tfidf"]
+        )
+        vectors[miss] = reduce_features(model["reducer"], full_matrix)
+    return itemids, vectors, keys, int(hit.sum())
+
+def save_embedding_cache(keys, vectors):
+    """Publishes the current items' vectors as the new cache, sorted by key.
+
+    Only current items are kept, so entries of changed or removed items age out.
+    """
+    os.makedirs(EMBEDDING_WORK_DIR, exist_ok=True)
+    path = os.path.join(EMBEDDING_WORK_DIR, "embedding_cache.new.npy")
+    order = np.argsort(keys, kind="stable")
+    cache = np.lib.format.open_memmap(path, mode="w+", dtype=cache_dtype(vectors.shape[1]), shape=(len(keys),))
+    for start in range(0, len(order), 100000):
+        rows = order[start:start + 100000]
+        cache["key"][start:start + len(rows)] = keys[rows]
+        cache["vector"][start:start + len(rows)] = vectors[rows]
+    cache.flush()
+    del cache
+    s3.upload_file(path, S3_BUCKET, EMBEDDING_CACHE_FILE)
+    logging.info(f"Saved embedding cache with {len(keys)} entries to s3://{S3_BUCKET}/{EMBEDDING_CACHE_FILE}")
+
+def fit_streaming_features(batch_paths):
+    """Streaming pass one: vocabulary, IDF and numeric ranges over every batch.
+
+    Only per-term counts and per-column min/max are kept in memory. Returns
+    a TfidfVectorizer equivalent to fitting on all batches at once, the
+    fitted MinMaxScaler and its numeric column list.
+    """
+    term_counts = Counter()
+    doc_counts = Counter()
+    n_docs = 0
+    col_min = {}
+    col_max = {}
+    for path in batch_paths:
+        items = pd.read_parquet(path)
+        _, texts, _ = preprocess_features(items, numeric_cols=[])
+        counter = CountVectorizer(dtype=np.int64)
+        try:
+            counts = counter.fit_transform(texts)
+        except ValueError:  # batch without any tokens
+            counts = None
+        if counts is not None:
+            terms = counter.get_feature_names_out()
+            term_counts.update(dict(zip(terms, np.asarray(counts.sum(axis=0)).ravel().tolist())))
+            doc_counts.update(dict(zip(terms, np.asarray((counts > 0).sum(axis=0)).ravel().tolist())))
+        n_docs += len(texts)
+        numeric = items.select_dtypes(include=[np.number])
+        for col in numeric.columns:
+            col_min[col] = min(col_min.get(col, np.inf), numeric[col].min())
+            col_max[col] = max(col_max.get(col, -np.inf), numeric[col].max())
+
+    # same selection as TfidfVectorizer(max_features=...): most frequent terms, sorted
+    top_terms = sorted(term for term, _ in term_counts.most_common(TFIDF_MAX_FEATURES))
+    tfidf_model = TfidfVectorizer(vocabulary={term: i for i, term in enumerate(top_terms)}, dtype=np.float32)
+    doc_freq = np.array([doc_counts[term] for term in top_terms], dtype=np.float64)
+    tfidf_model.idf_ = np.log((1 + n_docs) / (1 + doc_freq)) + 1  # smooth_idf
+
+    numeric_cols = list(col_min)
+    scaler = None
+    if numeric_cols:
+        # fitting on the [min, max] rows gives exactly the global data_min_/data_max_
+        scaler = MinMaxScaler().fit(pd.DataFrame([col_min, col_max], columns=numeric_cols).astype(np.float64))
+    logging.info(f"Streaming fit: {n_docs} items, {len(top_terms)} terms, {len(numeric_cols)} numeric columns.")
+    return tfidf_model, scaler, numeric_cols
+
+def featurize_batch(items, tfidf_model, scaler, numeric_cols):
+    itemids, texts, numeric_matrix = preprocess_features(items, scaler, numeric_cols)
+    full_matrix, _ = generate_embeddings(texts, numeric_matrix, tfidf_model)
+    return itemids, full_matrix
+
+def fit_streaming_reducer(batch_paths, featurize):
+    """Streaming pass two: fits the reducer batch by batch.
+
+    svd uses IncrementalPCA.partial_fit on chunks of EMBEDDING_CHUNK_ROWS
+    densified rows (only one chunk is dense at a time); random projection
+    needs no data. Returns None when no reduction is needed.
+    """
+    n_features = featurize(pd.read_parquet(batch_paths[0]))[1].shape[1]
+    if n_features <= PCA_COMPONENTS:
+        return None
+    if REDUCER == "random_projection":
+        return make_reducer().fit(sp.csr_matrix((1, n_features), dtype=np.float32))
+
+    reducer = IncrementalPCA(n_components=PCA_COMPONENTS)
+    chunk_rows = max(EMBEDDING_CHUNK_ROWS, PCA_COMPONENTS)
+    pending = []
+    pending_rows = 0
+    for path in batch_paths:
+        _, matrix = featurize(pd.read_parquet(path))
+        for start in range(0, matrix.shape[0], chunk_rows):
+            pending.append(matrix[start:start + chunk_rows])
+            pending_rows += pending[-1].shape[0]
+            # partial_fit needs at least n_components rows per call; a smaller tail is left out
+            if pending_rows >= PCA_COMPONENTS:
+                reducer.partial_fit(sp.vstack(pending).toarray())
+                pending, pending_rows = [], 0
+    if not hasattr(reducer, "components_"):
+        raise ValueError(f"Need at least PCA_COMPONENTS={PCA_COMPONENTS} items to fit the reducer.")
+    return reducer
+
+def fit_streaming_model(batch_paths):
+    """Streaming passes one and two: features, then reducer."""
+    tfidf_model, scaler, numeric_cols = fit_streaming_features(batch_paths)
+    featurize = lambda items: featurize_batch(items, tfidf_model, scaler, numeric_cols)
+    reducer = fit_streaming_reducer(batch_paths, featurize)
+    return make_embedding_model(tfidf_model, scaler, numeric_cols, reducer)
+
+def merge_bucket_count(total_rows, bucket_rows=EMBEDDING_BUCKET_ROWS):
+    """Buckets needed for bucket_rows items each; event rows bound the item count from above."""
+    return max(1, -(-total_rows // max(1, bucket_rows)))
+
+def stage_item_buckets(frames, work_dir, n_buckets):
+    """Consolidates files into n_buckets local batches holding each item exactly once.
+
+    Every file's consolidated items are spread over hash buckets of itemid,
+    then each bucket's parts are merged with consolidate_items in file order,
+    the same merge main() applies to the whole dataset. Returns the bucket
+    batch paths.
+    """
+    bucket_dir = os.path.join(work_dir, "buckets")
+    shutil.rmtree(bucket_dir, ignore_errors=True)
+    for idx, (key, df) in enumerate(frames):
+        logging.info(f"Staging file {idx+1}: {key}")
+        items = consolidate_items(df)
+        buckets = pd.util.hash_array(items['itemid'].to_numpy(dtype=object)) % n_buckets
+        for bucket, part in items.groupby(buckets, sort=False):
+            os.makedirs(os.path.join(bucket_dir, f"{bucket:05d}"), exist_ok=True)
+            part.to_parquet(os.path.join(bucket_dir, f"{bucket:05d}", f"part_{idx:05d}.parquet"), index=False)
+
+    batch_paths = []
+    for bucket in sorted(os.listdir(bucket_dir)) if os.path.isdir(bucket_dir) else []:
+        parts = sorted(os.listdir(os.path.join(bucket_dir, bucket)))
+        items = consolidate_items(pd.concat([pd.read_parquet(os.path.join(bucket_dir, bucket, part)) for part in parts], ignore_index=True))
+        path = os.path.join(work_dir, f"batch_{bucket}.parquet")
+        items.to_parquet(path, index=False)
+        shutil.rmtree(os.path.join(bucket_dir, bucket))
+        batch_paths.append(path)
+    return batch_paths
+
+def write_streaming_embeddings(batch_paths, model, cache, work_dir):
+    """Streaming pass three: embeds batch by batch into on-disk arrays.
+
+    Returns the memory-mapped int64 itemids, float32 matrix and matching
+    content keys.
+    """
+    n_items = sum(pq.ParquetFile(batch_path).metadata.num_rows for batch_path in batch_paths)
+    paths = {name: os.path.join(work_dir, f"{name}.npy") for name in ("itemids", "embeddings", "keys")}
+    final_ids = np.lib.format.open_memmap(paths["itemids"], mode="w+", dtype=np.int64, shape=(n_items,))
+    final = np.lib.format.open_memmap(paths["embeddings"], mode="w+", dtype=np.float32, shape=(n_items, model["dim"]))
+    final_keys = np.lib.format.open_memmap(paths["keys"], mode="w+", dtype=np.uint64, shape=(n_items,))
+    hits = 0
+    start = 0
+    for batch_path in batch_paths:
+        itemids, vectors, keys, batch_hits = embed_items(pd.read_parquet(batch_path), model, cache)
+        final_ids[start:start + len(itemids)] = np.asarray(itemids).astype(np.int64)
+        final[start:start + len(itemids)] = vectors
+        final_keys[start:start + len(itemids)] = keys
+        start += len(itemids)
+        hits += batch_hits
+    for array in (final_ids, final, final_keys):
+        array.flush()
+    del final_ids, final, final_keys
+    logging.info(f"Embedding cache: {hits} hits, {n_items - hits} misses.")
+    logging.info(f"Wrote {n_items} unique item embeddings from {len(batch_paths)} batches.")
+    return tuple(np.load(paths[name], mmap_mode="r") for name in ("itemids", "embeddings", "keys"))
+
+def streaming_main():
+    """Out-of-core variant of main(): memory is bounded by one bucket, not the dataset.
+
+    Items are merged into hash buckets staged in EMBEDDING_WORK_DIR, so the
+    embedded items match main() and the fit and transform passes re-read
+    local files instead of S3. The bucket count is derived from the row
+    count in the parquet footers so each bucket holds about
+    EMBEDDING_BUCKET_ROWS items.
+    """
+    logging.info("Starting streaming item embedding generation...")
+    os.makedirs(EMBEDDING_WORK_DIR, exist_ok=True)
+    for name in os.listdir(EMBEDDING_WORK_DIR):
+        if name.startswith("batch_") and name.endswith(".parquet"):  # left over from an earlier run
+            os.remove(os.path.join(EMBEDDING_WORK_DIR, name))
+    parquet_files = list_parquet_files()
+    n_buckets = merge_bucket_count(count_parquet_rows(parquet_files))
+    logging.info(f"Merging items in {n_buckets} buckets of up to about {EMBEDDING_BUCKET_ROWS} items.")
+    batch_paths = stage_item_buckets(prefetch_parquet_files(parquet_files), EMBEDDING_WORK_DIR, n_buckets)
+    if not batch_paths:
+        raise ValueError("No parquet files found for embedding.")
+
+    model = get_embedding_model(lambda: fit_streaming_model(batch_paths))
+    cache = load_embedding_cache(model["dim"])
+    itemids, vectors, keys = write_streaming_embeddings(batch_paths, model, cache, EMBEDDING_WORK_DIR)
+
+    logging.info(f"Final embedding matrix shape: {vectors.shape}")
+    save_embeddings_to_s3(itemids, vectors)
+    save_embedding_cache(keys, vectors)
+    logging.info("Item embeddings generation complete.")
+
+def save_embeddings_to_s3(itemids, vectors):
+    logging.info("Saving final embeddings to S3...")
+    artifact_bundle.write_bundle(EMBEDDING_PREFIX, itemids, vectors, dtype=EMBEDDING_BUNDLE_DTYPE, work_dir=EMBEDDING_WORK_DIR)
     logging.info(f"Saved embeddings to s3://{S3_BUCKET}/{EMBEDDING_PREFIX}")
 
 def main():
     logging.info("Starting item embedding generation...")
-    all_vectors = []
-    all_itemids = []
+    item_frames = []
 
     parquet_files = list_parquet_files()
-    tfidf_model = None  # Train on first batch
 
-    # incrementally process each parquet file
-    for idx, key in enumerate(parquet_files):
+    # consolidate each parquet file to unique items, then across files
+    for idx, (key, df) in enumerate(prefetch_parquet_files(parquet_files)):
         logging.info(f"Processing file {idx+1}/{len(parquet_files)}: {key}")
-        df = load_parquet_from_s3(key)
-        itemids, texts, numeric_matrix = preprocess_features(df)
+        item_frames.append(consolidate_items(df))
 
-        if tfidf_model is None:
-            vectors, tfidf_model = generate_embeddings(texts, numeric_matrix)
-        else:
-            vectors, _ = generate_embeddings(texts, numeric_matrix, tfidf_model)
-
-        all_vectors.append(vectors)
-        all_itemids.extend(itemids)
+    items = consolidate_items(pd.concat(item_frames, ignore_index=True))
 
-    # Stack and reduce once
-    full_matrix = np.vstack(all_vectors)
-    reduced_matrix = reduce_dimensionality(full_matrix)
+    # Embed the unique items once, transforming only those not in the cache
+    model = get_embedding_model(lambda: fit_embedding_model(items))
+    cache = load_embedding_cache(model["dim"])
+    itemids, vectors, keys, hits = embed_items(items, model, cache)
+    logging.info(f"Embedding cache: {hits} hits, {len(keys) - hits} misses.")
 
-    logging.info(f"Final embedding matrix shape: {reduced_matrix.shape}")
-    save_embeddings_to_s3(all_itemids, reduced_matrix)
+    logging.info(f"Final embedding matrix shape: {vectors.shape}")
+    save_embeddings_to_s3(itemids, vectors)
+    save_embedding_cache(keys, vectors)
     logging.info("Item embeddings generation complete.")
 
 def generate_item_embeddings():
     try:
-        main()
+        if EMBEDDING_MODE == "streaming":
+            streaming_main()
+        else:
+            main()
     except Exception as e:
         logging.error(f"Error generating item embeddings: {e}")
         raise
@@ -1,5 +1,8 @@
-import os, io, pickle, boto3, faiss, numpy as np
+import os, re, json, fcntl, boto3, faiss, numpy as np
 import logging
+from botocore.exceptions import ClientError
+from ML import artifact_bundle
+from ML.artifact_bundle import ArtifactChangedError
 
 logging.basicConfig(
     level=logging.INFO,
@@ -9,58 +12,391 @@ logging.basicConfig(
 REGION = os.getenv("AWS_REGION", "us-east-1")
 S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
 FAISS_INDEX_FILE = os.getenv("FAISS_INDEX_FILE", "faiss.index")
-ITEMID_MAP_FILE = os.getenv("ITEMID_MAP_FILE", "itemid_map.pkl")
+ITEM_BUNDLE_PREFIX = os.getenv("ITEM_BUNDLE_PREFIX", "item_bundle")
+# unset serves the vectors as published (memory-mapped); float16 halves a float32 matrix at a small precision cost
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE")
+# SHA-256 check of bundle files when they are downloaded into the artifact cache (cached copies are trusted)
+VERIFY_ARTIFACT_CHECKSUMS = os.getenv("VERIFY_ARTIFACT_CHECKSUMS", "true").lower() == "true"
+NEIGHBOR_IDS_FILE = os.getenv("NEIGHBOR_IDS_FILE", "neighbor_ids.npy")
+NEIGHBOR_SCORES_FILE = os.getenv("NEIGHBOR_SCORES_FILE", "neighbor_scores.npy")
+MANIFEST_FILE = os.getenv("MANIFEST_FILE", "artifact_manifest.json")
+# written by build_neighbor_table: the index version the table was built from and its files' pins
+NEIGHBOR_MANIFEST_FILE = os.getenv("NEIGHBOR_MANIFEST_FILE", "neighbor_table_manifest.json")
+# local artifact cache shared by all worker processes on a host
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/tmp/recommender_artifacts")
+# cached versions kept per artifact; older ones may still be mapped by a previous generation
+ARTIFACT_CACHE_KEEP = int(os.getenv("ARTIFACT_CACHE_KEEP", 2))
+# memory-map the index so worker processes share one page-cache copy
+FAISS_MMAP = os.getenv("FAISS_MMAP", "true").lower() == "true"
+# attempts at downloading an unpinned artifact that keeps changing between the ETag probe and the download
+ARTIFACT_DOWNLOAD_ATTEMPTS = int(os.getenv("ARTIFACT_DOWNLOAD_ATTEMPTS", 3))
 
 
+def artifact_pin(manifest, key):
+    """ETag/VersionId the manifest recorded for key; None for manifests written before pinning."""
+    return ((manifest or {}).get("artifacts") or {}).get(key)
 
-
-
-def load_faiss_index():
+def load_faiss_index(manifest=None):
     logging.info("Loading FAISS index from S3: %s", FAISS_INDEX_FILE)
-    s3 = boto3.client("s3", region_name=REGION)
-    buf = io.BytesIO()
-    s3.download_fileobj(S3_BUCKET, FAISS_INDEX_FILE, buf)
-    buf.seek(0)
-    index = faiss.read_index(faiss.PyCallbackIOReader(buf.read))
+    local_path = download_artifact(FAISS_INDEX_FILE, artifact_pin(manifest, FAISS_INDEX_FILE))
+    if FAISS_MMAP:
+        # IO_FLAG_MMAP maps IVF lists, IO_FLAG_MMAP_IFC (newer FAISS) maps flat codes;
+        # IVF indexes reject the combination, so retry those with IO_FLAG_MMAP alone
+        io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        if not hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            logging.warning("FAISS %s cannot memory-map flat indexes (no IO_FLAG_MMAP_IFC); "
+                            "each worker loads its own copy. Upgrade faiss-cpu to share it.", faiss.__version__)
+        try:
+            index = faiss.read_index(local_path, io_flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+        except RuntimeError:
+            index = faiss.read_index(local_path, io_flags)
+    else:
+        index = faiss.read_index(local_path)
     logging.info("FAISS index loaded successfully.")
     return index
 
-def load_itemid_map():
-    logging.info("Loading item ID map from S3: %s", ITEMID_MAP_FILE)
-    s3 = boto3.client("s3", region_name=REGION)
-    buf = io.BytesIO()
-    s3.download_fileobj(S3_BUCKET, ITEMID_MAP_FILE, buf)
-    buf.seek(0)
-    itemid_ids = pickle.load(buf)
-    logging.info("Item ID map loaded successfully.")
-    # convert all item IDs to whole numbers
-    itemid_ids = [str(int(float(itemid))) for itemid in itemid_ids] 
-    
-    logging.info("Item IDs converted to string format.")
-    
-    return {
-        "itemid_to_index": {itemid: idx for idx, itemid in enumerate(itemid_ids)},
-        "index_to_itemid": {idx: itemid for idx, itemid in enumerate(itemid_ids)},
-    }
+def apply_search_params(index, search_params):
+    """Applies search-time parameters (nprobe, efSearch, ...) stored in the manifest."""
+    if not search_params:
+        return index
+    parameter_space = faiss.ParameterSpace()
+    for name, value in search_params.items():
+        parameter_space.set_index_parameter(index, name, value)
+    logging.info("Applied search parameters: %s", search_params)
+    return index
+
+def rerank_exact(item_vectors, queries, candidates, k):
+    """Re-orders approximate candidates by exact L2 distance to the stored embeddings.
+
+    candidates is the (n x k') row matrix from an approximate search; returns
+    (distances, rows) cut to k columns with -1 padding kept last.
+    """
+    valid = candidates >= 0
+    candidate_vectors = item_vectors[np.where(valid, candidates, 0)].astype(np.float32)
+    distances = np.square(candidate_vectors - queries[:, None, :]).sum(axis=2)
+    distances[~valid] = np.inf
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+def parse_item_ids(values):
+    """Converts item IDs (ints or decimal strings) to int64; returns (ids, valid mask)."""
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(np.int64, copy=False), np.ones(values.shape, dtype=bool)
+    try:
+        return values.astype(np.int64), np.ones(values.shape, dtype=bool)
+    except (ValueError, TypeError, OverflowError):
+        pass
+    ids = np.full(values.shape, -1, dtype=np.int64)
+    valid = np.zeros(values.shape, dtype=bool)
+    for pos, value in np.ndenumerate(values):
+        try:
+            ids[pos], valid[pos] = int(value), True
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return ids, valid
+
+class ItemIdMap:
+    """Array-backed mapping between item IDs and index/vector rows.
+
+    Row i belongs to item_ids[i], a sorted int64 array (as published in the
+    item bundle), so ID -> row is a binary search and row -> ID plain
+    indexing. Both directions take whole arrays, e.g. FAISS result matrices.
+    """
 
-def get_similar_items(itemid, index, itemid_to_index, index_to_itemid, k=5):
+    def __init__(self, item_ids):
+        self.item_ids = np.asarray(item_ids, dtype=np.int64)
+        if self.item_ids.ndim != 1 or np.any(self.item_ids[1:] <= self.item_ids[:-1]):
+            raise ValueError("Item IDs must be a sorted, unique 1-d array.")
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def __contains__(self, item_id):
+        return self.row(item_id) >= 0
+
+    def to_rows(self, item_ids):
+        """Rows for an array of item IDs (or index labels), -1 where unknown."""
+        ids, valid = parse_item_ids(item_ids)
+        if len(self.item_ids) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.item_ids, ids), len(self.item_ids) - 1)
+        return np.where(valid & (self.item_ids[pos] == ids), pos, -1)
+
+    def row(self, item_id):
+        return int(self.to_rows([item_id])[0])
+
+    def to_ids(self, rows):
+        """Item IDs for an array of rows, -1 for padding rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        return np.where(rows >= 0, self.item_ids[np.maximum(rows, 0)], -1)
+
+def search_with_rerank(index, item_vectors, queries, k, rerank_factor=1, search_fn=None, label_to_row=None):
+    """index.search with an optional exact re-ranking stage over item_vectors.
+
+    For ID-mapped indexes pass label_to_row (ItemIdMap.to_rows); results are then returned as
+    item vector rows, the same as for indexes labelled by row position.
+    """
+    search = search_fn or index.search
+    if rerank_factor <= 1 or item_vectors is None:
+        distances, candidates = search(queries, k)
+        if label_to_row is not None:
+            candidates = label_to_row(candidates)
+        return distances, candidates
+    _, candidates = search(queries, k * rerank_factor)
+    if label_to_row is not None:
+        candidates = label_to_row(candidates)
+    return rerank_exact(item_vectors, np.asarray(queries, dtype=np.float32), candidates, k)
+
+def load_item_bundle(manifest=None):
+    """Returns (item_ids, vectors) of the published item bundle, memory-mapped from the local artifact cache."""
+    prefix = (manifest or {}).get("item_bundle", ITEM_BUNDLE_PREFIX)
+    logging.info("Loading item bundle from S3: %s", prefix)
+    bundle = artifact_bundle.read_bundle(prefix, fetch=download_artifact, verify=VERIFY_ARTIFACT_CHECKSUMS,
+                                         pins=(manifest or {}).get("artifacts"))
+    if bundle is None:
+        raise ValueError(f"No item bundle published at {prefix}.")
+    _, item_ids, vectors = bundle
+    return item_ids, vectors
+
+def load_itemid_map(item_ids=None):
+    if item_ids is None:
+        item_ids, _ = load_item_bundle()
+    id_map = ItemIdMap(item_ids)
+    logging.info("Item ID map loaded with %d items.", len(id_map))
+    return id_map
+
+def get_similar_items(itemid, index, id_map, k=5, item_vectors=None, search_fn=None, label_to_row=None):
     logging.info("Querying similar items for itemid: %s", itemid)
-    if itemid not in itemid_to_index:
+    query_idx = id_map.row(itemid)
+    if query_idx < 0:
         logging.error("Item ID %s not found in index.", itemid)
         raise ValueError("Item ID not found.")
-    query_idx = itemid_to_index[itemid]
-    query_vec = index.reconstruct(query_idx).reshape(1, -1)
-    scores, indices = index.search(query_vec, k + 1)
-    similar_items = [index_to_itemid[i] for i in indices[0] if index_to_itemid[i] != itemid][:k]
+    if item_vectors is not None and query_idx < item_vectors.shape[0]:
+        query_vec = np.asarray(item_vectors[query_idx], dtype=np.float32).reshape(1, -1)
+    else:
+        query_vec = index.reconstruct(query_idx).reshape(1, -1)
+    search = search_fn or index.search
+    scores, indices = search(query_vec, k + 1)
+    if label_to_row is not None:
+        indices = label_to_row(indices)
+    rows = indices[0]
+    rows = rows[(rows >= 0) & (rows != query_idx)][:k]
+    similar_items = id_map.to_ids(rows).astype(str).tolist()
     logging.info("Found %d similar items for itemid: %s", len(similar_items), itemid)
     
     return similar_items
 
+def load_item_vectors(index, vectors=None):
+    """Returns the read-only item embedding matrix, row-aligned with the index.
+
+    vectors is the bundle matrix from load_item_bundle; it is served
+    memory-mapped unless EMBEDDING_DTYPE asks for another dtype. Falls back to
+    reconstructing every vector from the index when no bundle is available.
+    """
+    if vectors is None:
+        try:
+            _, vectors = load_item_bundle()
+        except Exception as e:
+            logging.warning("Item vectors unavailable, reconstructing from index: %s", e)
+            vectors = index.reconstruct_n(0, index.ntotal)
+    vectors = np.ascontiguousarray(vectors, dtype=EMBEDDING_DTYPE or vectors.dtype)
+    vectors.setflags(write=False)
+    logging.info("Item vectors loaded with shape %s (%s).", vectors.shape, vectors.dtype)
+    return vectors
+
+def recency_weights(timestamps, half_life_days):
+    """Exponential-decay weights relative to the newest timestamp in a history.
+
+    Returns uniform weights when decay is disabled or timestamps cannot be parsed.
+    """
+    weights = np.ones(len(timestamps), dtype=np.float32)
+    if half_life_days <= 0 or not timestamps:
+        return weights
+    try:
+        times = np.array(timestamps, dtype="datetime64[s]")
+    except (ValueError, TypeError):
+        return weights
+    if np.isnat(times).any():
+        return weights
+    age_days = (times.max() - times).astype(np.float64) / 86400.0
+    return np.power(0.5, age_days / half_life_days).astype(np.float32)
+
+def build_user_vectors(item_vectors, rows_per_user, weights_per_user):
+    """Weighted average of each user's history rows, for many users at once.
+
+    The ragged histories are concatenated so gathering, weighting and the
+    per-user reductions are single NumPy operations. Every history must be
+    non-empty. Returns an (n_users x d) float32 matrix.
+    """
+    lengths = np.fromiter((len(rows) for rows in rows_per_user), dtype=np.int64, count=len(rows_per_user))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    rows = np.concatenate(rows_per_user)
+    weights = np.concatenate(weights_per_user).astype(np.float32)
+    weighted = item_vectors[rows].astype(np.float32) * weights[:, None]
+    sums = np.add.reduceat(weighted, offsets, axis=0)
+    return sums / np.add.reduceat(weights, offsets)[:, None]
+
+def download_artifact(key, pin=None, sha256=None):
+    """Returns a local path for an S3 artifact, downloading it only when needed.
+
+    Cached files are named after the object's ETag, so a current copy is
+    reused across restarts and worker processes, and a new upload gets a new
+    file instead of overwriting one that may still be memory-mapped. A file
+    lock makes sure only one worker per host downloads a given version.
+    Downloads are conditional on that ETag, so the cached file always holds
+    the version it is named after. With a pin from a manifest exactly that
+    object is fetched, and ArtifactChangedError is raised if it has been
+    overwritten since; unpinned artifacts are re-probed and retried. A
+    sha256 is checked once, before a download enters the cache.
+    """
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    s3 = boto3.client("s3", region_name=REGION)
+    for attempt in range(1, max(1, ARTIFACT_DOWNLOAD_ATTEMPTS) + 1):
+        etag = pin["etag"] if pin else s3.head_object(Bucket=S3_BUCKET, Key=key)["ETag"]
+        try:
+            return download_artifact_version(s3, key, etag, (pin or {}).get("version_id"), sha256)
+        except ClientError as e:
+            if not artifact_bundle.is_precondition_failed(e):
+                raise
+            if pin:
+                raise ArtifactChangedError(f"{key} changed after the manifest pinning it was read.") from e
+            if attempt >= ARTIFACT_DOWNLOAD_ATTEMPTS:
+                raise ArtifactChangedError(f"{key} kept changing during {attempt} download attempts.") from e
+            logging.warning("%s changed during download, retrying (%d/%d).", key, attempt, ARTIFACT_DOWNLOAD_ATTEMPTS)
+
+def download_artifact_version(s3, key, etag, version_id=None, sha256=None):
+    prefix = key.replace("/", "_")
+    local_path = os.path.join(ARTIFACT_DIR, f"{prefix}.{re.sub(r'[^0-9A-Za-z-]', '', etag)}")
+    if os.path.exists(local_path):
+        logging.info("Using cached artifact %s", local_path)
+        return local_path
+
+    with open(os.path.join(ARTIFACT_DIR, f"{prefix}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(local_path):
+                tmp_path = f"{local_path}.{os.getpid()}.part"
+                try:
+                    artifact_bundle.download_object(s3, key, tmp_path, {"etag": etag, "version_id": version_id})
+                    artifact_bundle.verify_checksum(tmp_path, sha256, key)
+                except (ClientError, ValueError):
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                os.replace(tmp_path, local_path)
+                logging.info("Downloaded s3://%s/%s to %s", S3_BUCKET, key, local_path)
+            prune_artifact_cache(prefix, local_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return local_path
+
+def prune_artifact_cache(prefix, current_path):
+    """Deletes all but the ARTIFACT_CACHE_KEEP newest cached versions of an artifact.
+
+    Unlinking is safe for files still mapped by a running generation: the
+    data stays readable until the last mapping is closed.
+    """
+    versions = [
+        os.path.join(ARTIFACT_DIR, name) for name in os.listdir(ARTIFACT_DIR)
+        if name.startswith(f"{prefix}.") and not name.endswith((".lock", ".part"))
+    ]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    for path in versions[max(ARTIFACT_CACHE_KEEP, 1):]:
+        if path != current_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def read_json_artifact(key):
+    """Returns (document, ETag) of a JSON object in S3, or (None, None) if absent."""
+    s3 = boto3.client("s3", region_name=REGION)
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return json.loads(response["Body"].read()), response["ETag"]
+
+def load_manifest():
+    """Loads the artifact manifest written by train_faiss_index, or None if absent."""
+    manifest, etag = read_json_artifact(MANIFEST_FILE)
+    if manifest is None:
+        logging.warning("No artifact manifest found at %s.", MANIFEST_FILE)
+        return None
+    manifest["etag"] = etag
+    return manifest
+
+def load_neighbor_manifest():
+    """Loads the neighbor table manifest written by build_neighbor_table, or None if absent."""
+    manifest, _ = read_json_artifact(NEIGHBOR_MANIFEST_FILE)
+    return manifest
+
+def head_etag(s3, key):
+    try:
+        return s3.head_object(Bucket=S3_BUCKET, Key=key)["ETag"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            raise
+    return None
+
+def get_artifact_etag():
+    """Cheap version probe for hot reload.
+
+    The artifact manifest is written last by training, so its ETag changes
+    exactly once per complete artifact set; the neighbor table manifest
+    likewise once per table build. The probe combines both. Deployments
+    without a manifest fall back to the FAISS index ETag.
+    """
+    s3 = boto3.client("s3", region_name=REGION)
+    etags = [head_etag(s3, MANIFEST_FILE) or head_etag(s3, FAISS_INDEX_FILE), head_etag(s3, NEIGHBOR_MANIFEST_FILE)]
+    return "|".join(etag for etag in etags if etag) or None
+
+def load_neighbor_table(manifest=None):
+    """Loads the precomputed neighbor table as memory-mapped arrays.
+
+    Returns (neighbor_ids, neighbor_scores), or (None, None) when the table
+    has not been built yet, or was built for a different index version than
+    the manifest describes, so callers can fall back to live FAISS search.
+    The table files are fetched exactly as pinned by the neighbor manifest.
+    """
+    neighbor_manifest = load_neighbor_manifest()
+    if manifest is not None and (neighbor_manifest or {}).get("index_version") != manifest.get("version"):
+        logging.warning("Neighbor table is stale for artifact version %s, using live FAISS search only.", manifest.get("version"))
+        return None, None
+    logging.info("Loading neighbor table from S3: %s, %s", NEIGHBOR_IDS_FILE, NEIGHBOR_SCORES_FILE)
+    try:
+        ids_path = download_artifact(NEIGHBOR_IDS_FILE, artifact_pin(neighbor_manifest, NEIGHBOR_IDS_FILE))
+        scores_path = download_artifact(NEIGHBOR_SCORES_FILE, artifact_pin(neighbor_manifest, NEIGHBOR_SCORES_FILE))
+    except Exception as e:
+        logging.warning("Neighbor table unavailable, using live FAISS search only: %s", e)
+        return None, None
+    neighbor_ids = np.load(ids_path, mmap_mode="r")
+    neighbor_scores = np.load(scores_path, mmap_mode="r")
+    logging.info("Neighbor table loaded with shape %s.", neighbor_ids.shape)
+    return neighbor_ids, neighbor_scores
+
+def get_similar_items_from_table(itemid, neighbor_ids, id_map, k=5):
+    """Answers an item-similarity query with a row lookup in the neighbor table.
+
+    Returns None when the item was added after the table was built or when k
+    exceeds the precomputed width, so the caller can fall back to live search.
+    """
+    query_idx = id_map.row(itemid)
+    if query_idx < 0:
+        raise ValueError("Item ID not found.")
+    if neighbor_ids is None or query_idx >= neighbor_ids.shape[0] or k > neighbor_ids.shape[1]:
+        return None
+    rows = neighbor_ids[query_idx, :k]
+    return id_map.to_ids(rows[rows >= 0]).astype(str).tolist()
+
 # Uncomment the following lines to test the function directly
 # def query_faiss():
 #     test_itemid = "49337"
 #     try:
-#         similar_items = get_similar_items(test_itemid, load_faiss_index(), load_itemid_map()["itemid_to_index"], load_itemid_map()["index_to_itemid"])
+#         similar_items = get_similar_items(test_itemid, load_faiss_index(), load_itemid_map())
 #         logging.info("Similar items for %s: %s", test_itemid, similar_items)
 #     except ValueError as e:
 #         logging.error("Error retrieving similar items: %s", e)
@@ -1,10 +1,14 @@
 import os
 import io
-import pickle
+import json
+import uuid
+from datetime import datetime, timezone
 import boto3
 import numpy as np
 import faiss
 import logging
+from botocore.exceptions import ClientError
+from ML import query_faiss, artifact_bundle
 
 # Configure logging
 logging.basicConfig(
@@ -14,61 +18,261 @@ logging.basicConfig(
 
 REGION = os.getenv("AWS_REGION", "us-east-1")
 S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
-EMBEDDING_PREFIX = os.getenv("EMBEDDING_PREFIX", "embeddings.pkl")
+EMBEDDING_PREFIX = os.getenv("EMBEDDING_PREFIX", "embeddings")
 FAISS_INDEX_FILE = os.getenv("FAISS_INDEX_FILE", "faiss.index")
-ITEMID_MAP_FILE = os.getenv("ITEMID_MAP_FILE", "itemid_map.pkl")
+# serving bundle: sorted int64 item IDs and the normalized vectors, row-aligned
+ITEM_BUNDLE_PREFIX = os.getenv("ITEM_BUNDLE_PREFIX", "item_bundle")
+# float16 halves the published matrix; serving maps it as stored
+ITEM_VECTORS_DTYPE = os.getenv("ITEM_VECTORS_DTYPE", "float32")
+MANIFEST_FILE = os.getenv("MANIFEST_FILE", "artifact_manifest.json")
+
+# index type: flat, ivf_flat, ivf_pq, hnsw or sq8
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+IVF_NLIST = int(os.getenv("IVF_NLIST", 0))  # 0 picks ~4*sqrt(n)
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", 16))
+IVF_TRAIN_SAMPLE = int(os.getenv("IVF_TRAIN_SAMPLE", 256))  # training points per list
+PQ_M = int(os.getenv("PQ_M", 16))
+PQ_NBITS = int(os.getenv("PQ_NBITS", 8))
+HNSW_M = int(os.getenv("HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 64))
+# >1 fetches k * RERANK_FACTOR candidates at serving time and re-ranks them exactly
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", 1))
+# "full" rebuilds the index, "update" applies adds/changes/removals to the published one
+FAISS_UPDATE_MODE = os.getenv("FAISS_UPDATE_MODE", "full")
+# max absolute component difference below which an item's vector counts as unchanged
+VECTOR_CHANGE_TOLERANCE = float(os.getenv("VECTOR_CHANGE_TOLERANCE", 1e-6))
+# index types whose FAISS implementation supports remove_ids
+REMOVABLE_INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "sq8")
 
 s3 = boto3.client("s3", region_name=REGION)
 
 def load_embeddings():
-    logging.info("Loading embeddings from S3 bucket: %s, key: %s", S3_BUCKET, EMBEDDING_PREFIX)
-    response = s3.get_object(Bucket=S3_BUCKET, Key=EMBEDDING_PREFIX)
-    buffer = io.BytesIO(response['Body'].read())
-    data = pickle.load(buffer)
-    logging.info("Loaded %d embeddings.", len(data['itemid']))
-    return data['itemid'], np.array(data['vectors'], dtype=np.float32)
+    """Returns the int64 item IDs and memory-mapped vectors of the embedding bundle."""
+    logging.info("Loading embeddings from S3 bucket: %s, prefix: %s", S3_BUCKET, EMBEDDING_PREFIX)
+    bundle = artifact_bundle.read_bundle(EMBEDDING_PREFIX)
+    if bundle is None:
+        raise ValueError(f"No embedding bundle at {EMBEDDING_PREFIX}; run generate_item_embeddings first.")
+    _, item_ids, vectors = bundle
+    logging.info("Loaded %d embeddings.", len(item_ids))
+    return item_ids, vectors
+
+def to_item_ids(itemid):
+    """Converts item IDs (str/float/int, e.g. "49337.0") to int64 labels."""
+    itemid = np.asarray(itemid)
+    if np.issubdtype(itemid.dtype, np.integer):
+        return itemid.astype(np.int64, copy=False)
+    return itemid.astype(np.float64).astype(np.int64)
+
+def prepare_items(itemid, vectors):
+    """Deduplicates by item ID (last occurrence wins) and sorts by ID.
+
+    Returns int64 item IDs and the row-aligned vectors; the sorted order is
+    the row order of the published item vectors.
+    """
+    item_ids = to_item_ids(itemid)
+    # np.unique keeps the first occurrence, so search the reversed arrays
+    unique_ids, reversed_pos = np.unique(item_ids[::-1], return_index=True)
+    rows = len(item_ids) - 1 - reversed_pos
+    if len(unique_ids) < len(item_ids):
+        logging.info("Dropped %d duplicate item embeddings.", len(item_ids) - len(unique_ids))
+    return unique_ids, np.ascontiguousarray(vectors[rows], dtype=np.float32)
 
 def normalize_vectors(vectors):
     logging.info("Normalizing vectors.")
     faiss.normalize_L2(vectors)
     return vectors
 
-def build_faiss_index(vectors):
-    logging.info("Building FAISS index.")
-    dim = vectors.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(vectors)
+def index_spec_from_env():
+    """Index configuration from the environment, in the form stored in the manifest."""
+    return {
+        "index_type": FAISS_INDEX_TYPE,
+        "nlist": IVF_NLIST,
+        "nprobe": IVF_NPROBE,
+        "pq_m": PQ_M,
+        "pq_nbits": PQ_NBITS,
+        "hnsw_m": HNSW_M,
+        "ef_construction": HNSW_EF_CONSTRUCTION,
+        "ef_search": HNSW_EF_SEARCH,
+    }
+
+def default_nlist(n):
+    # ~4*sqrt(n) lists, capped so every list gets the 39 training points FAISS asks for
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+def create_index(dim, n, spec):
+    """Creates an empty (possibly untrained) index for a spec.
+
+    Returns the index and the search-time parameters that serving must apply
+    after loading it (FAISS does not persist nprobe/efSearch).
+    """
+    index_type = spec["index_type"]
+    nlist = spec.get("nlist") or default_nlist(n)
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim), {}
+    if index_type == "ivf_flat":
+        return faiss.index_factory(dim, f"IVF{nlist},Flat"), {"nprobe": spec["nprobe"]}
+    if index_type == "ivf_pq":
+        if dim % spec["pq_m"] != 0:
+            raise ValueError(f"PQ_M={spec['pq_m']} must divide the embedding dimension {dim}")
+        return faiss.index_factory(dim, f"IVF{nlist},PQ{spec['pq_m']}x{spec['pq_nbits']}"), {"nprobe": spec["nprobe"]}
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, spec["hnsw_m"])
+        index.hnsw.efConstruction = spec["ef_construction"]
+        return index, {"efSearch": spec["ef_search"]}
+    if index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit), {}
+    raise ValueError(f"Unknown FAISS_INDEX_TYPE: {index_type}")
+
+def train_index(index, vectors, train_points):
+    if index.is_trained:
+        return
+    if vectors.shape[0] > train_points:
+        sample = np.random.default_rng(0).choice(vectors.shape[0], train_points, replace=False)
+        vectors = vectors[np.sort(sample)]
+    logging.info("Training index on %d vectors.", vectors.shape[0])
+    index.train(vectors)
+
+def build_faiss_index(vectors, spec=None, item_ids=None):
+    """Builds and fills an index for a spec.
+
+    With item_ids, vectors are added under their int64 item IDs so search
+    results are item IDs rather than row positions: IVF indexes store the
+    IDs natively, the other types are wrapped in an IndexIDMap2.
+    """
+    spec = spec or index_spec_from_env()
+    logging.info("Building FAISS index (%s).", spec["index_type"])
+    n, dim = vectors.shape
+    index, search_params = create_index(dim, n, spec)
+    nlist = getattr(index, "nlist", 1)
+    train_index(index, vectors, max(IVF_TRAIN_SAMPLE * nlist, 10000))
+    if item_ids is None:
+        index.add(vectors)
+    else:
+        if not spec["index_type"].startswith("ivf"):
+            index = faiss.IndexIDMap2(index)
+        index.add_with_ids(vectors, item_ids)
     logging.info("FAISS index built with %d vectors.", vectors.shape[0])
-    return index
+    return index, search_params
+
+def diff_items(old_ids, old_vectors, new_ids, new_vectors, tolerance=VECTOR_CHANGE_TOLERANCE):
+    """Compares two sorted catalogs.
+
+    Returns (removed_ids, upsert_ids, upsert_vectors): IDs that are gone, and
+    the IDs/vectors that are new or whose vector changed beyond tolerance.
+    """
+    removed_ids = np.setdiff1d(old_ids, new_ids, assume_unique=True)
+    common_ids, old_rows, new_rows = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+    delta = np.abs(np.asarray(old_vectors[old_rows], dtype=np.float32) - new_vectors[new_rows]).max(axis=1, initial=0)
+    changed = new_rows[delta > tolerance]
+    added = np.flatnonzero(~np.isin(new_ids, old_ids, assume_unique=True))
+    upsert_rows = np.sort(np.concatenate([added, changed]))
+    logging.info("Catalog diff: %d added, %d changed, %d removed, %d unchanged.",
+                 len(added), len(changed), len(removed_ids), len(common_ids) - len(changed))
+    return removed_ids, new_ids[upsert_rows], new_vectors[upsert_rows]
 
-def save_index_to_s3(index, itemid):
+def load_published_artifacts():
+    """Loads the currently published index, item IDs and vectors for an in-place update.
+
+    Returns None when nothing usable is published (missing artifacts or a
+    legacy index labelled by row position).
+    """
+    manifest = query_faiss.load_manifest()
+    if manifest is None or manifest.get("index_labels") != "itemid":
+        logging.info("No ID-mapped index published yet.")
+        return None
+    # fetch exactly the objects the manifest pins, so the index and bundle belong to one version
+    pin = query_faiss.artifact_pin(manifest, FAISS_INDEX_FILE)
+    try:
+        response = s3.get_object(Bucket=S3_BUCKET, Key=FAISS_INDEX_FILE, **artifact_bundle.pin_args(**(pin or {})))
+    except ClientError as e:
+        if pin and artifact_bundle.is_precondition_failed(e):
+            raise artifact_bundle.ArtifactChangedError(f"{FAISS_INDEX_FILE} changed after the manifest was read.") from e
+        raise
+    index = faiss.deserialize_index(np.frombuffer(response["Body"].read(), dtype=np.uint8))
+    bundle = artifact_bundle.read_bundle(manifest.get("item_bundle", ITEM_BUNDLE_PREFIX), pins=manifest.get("artifacts"))
+    if bundle is None:
+        return None
+    _, item_ids, vectors = bundle
+    return manifest, index, item_ids, vectors
+
+def update_faiss_index(item_ids, vectors, spec):
+    """Applies catalog changes to the published index instead of rebuilding it.
+
+    Falls back to a full build when there is no ID-mapped index, the index
+    type changed, or it does not support removals (HNSW). The IVF coarse
+    quantizer is not retrained, so schedule periodic full rebuilds.
+    """
+    published = load_published_artifacts() if spec["index_type"] in REMOVABLE_INDEX_TYPES else None
+    if published is None or published[0].get("index_spec", {}).get("index_type") != spec["index_type"]:
+        logging.info("Incremental update not possible, running a full rebuild.")
+        return build_faiss_index(vectors, spec, item_ids)
+    manifest, index, old_ids, old_vectors = published
+    removed_ids, upsert_ids, upsert_vectors = diff_items(old_ids, old_vectors, item_ids, vectors)
+    stale_ids = np.concatenate([removed_ids, np.intersect1d(upsert_ids, old_ids, assume_unique=True)])
+    if len(stale_ids):
+        index.remove_ids(stale_ids.astype(np.int64))
+    if len(upsert_ids):
+        index.add_with_ids(upsert_vectors, upsert_ids)
+    logging.info("FAISS index updated in place, now %d vectors.", index.ntotal)
+    return index, manifest.get("search_params", {})
+
+def save_index_to_s3(index):
+    """Uploads the serialized index; returns its ETag/VersionId pin for the manifest."""
     logging.info("Saving FAISS index to S3: %s", FAISS_INDEX_FILE)
     index_bytes = faiss.serialize_index(index)
-    index_buffer = io.BytesIO(index_bytes)
-    s3.upload_fileobj(index_buffer, S3_BUCKET, FAISS_INDEX_FILE)
+    response = s3.put_object(Bucket=S3_BUCKET, Key=FAISS_INDEX_FILE, Body=index_bytes.tobytes())
     logging.info("FAISS index saved to s3://%s/%s", S3_BUCKET, FAISS_INDEX_FILE)
-    
-    # save itemid map
-    logging.info("Saving item ID map to S3: %s", ITEMID_MAP_FILE)
-    itemid_map_buffer = io.BytesIO()
-    pickle.dump(itemid, itemid_map_buffer)
-    itemid_map_buffer.seek(0)
-    s3.upload_fileobj(itemid_map_buffer, S3_BUCKET, ITEMID_MAP_FILE)
-    logging.info("Item ID map saved to s3://%s/%s", S3_BUCKET, ITEMID_MAP_FILE)
-     
+    return artifact_bundle.object_pin(response)
+
+def save_item_bundle_to_s3(item_ids, vectors):
+    """Saves the item IDs and normalized vectors, row-aligned, for serving-side lookups."""
+    logging.info("Saving item bundle to S3: %s", ITEM_BUNDLE_PREFIX)
+    return artifact_bundle.write_bundle(ITEM_BUNDLE_PREFIX, item_ids, vectors, dtype=ITEM_VECTORS_DTYPE)
+
+def save_manifest_to_s3(manifest):
+    """Publishes the artifact manifest; serving reloads when its ETag changes, so write it last."""
+    logging.info("Saving artifact manifest to S3: %s (version %s)", MANIFEST_FILE, manifest["version"])
+    manifest_buffer = io.BytesIO(json.dumps(manifest, indent=2).encode("utf-8"))
+    s3.upload_fileobj(manifest_buffer, S3_BUCKET, MANIFEST_FILE)
+    logging.info("Artifact manifest saved to s3://%s/%s", S3_BUCKET, MANIFEST_FILE)
+
+def new_artifact_version():
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
 def main():
     logging.info("Starting FAISS index training process.")
     itemid, vectors = load_embeddings()
     logging.info("Loaded %d itemid with vectors shape %s.", len(itemid), vectors.shape)
 
+    item_ids, vectors = prepare_items(itemid, vectors)
     vectors = normalize_vectors(vectors)
     logging.info("Vectors normalized.")
 
-    index = build_faiss_index(vectors)
+    spec = index_spec_from_env()
+    if FAISS_UPDATE_MODE == "update":
+        index, search_params = update_faiss_index(item_ids, vectors, spec)
+    else:
+        index, search_params = build_faiss_index(vectors, spec, item_ids)
     logging.info("FAISS index built.")
 
-    save_index_to_s3(index, itemid)
-    logging.info("FAISS index and item ID map saved successfully.")
+    index_pin = save_index_to_s3(index)
+    bundle_manifest = save_item_bundle_to_s3(item_ids, vectors)
+    save_manifest_to_s3({
+        "version": new_artifact_version(),
+        "num_items": int(index.ntotal),
+        "dim": int(vectors.shape[1]),
+        "index_spec": spec,
+        "index_labels": "itemid",
+        "search_params": search_params,
+        "rerank_factor": RERANK_FACTOR,
+        "item_bundle": ITEM_BUNDLE_PREFIX,
+        "files": [FAISS_INDEX_FILE, artifact_bundle.bundle_key(ITEM_BUNDLE_PREFIX, artifact_bundle.MANIFEST_NAME)]
+                 + [entry["key"] for entry in bundle_manifest["files"].values()],
+        # the exact object versions of this artifact set; readers reject anything else
+        "artifacts": {FAISS_INDEX_FILE: index_pin, **bundle_manifest["pins"]},
+    })
+    logging.info("FAISS index and item bundle saved successfully.")
     logging.info("Training complete.") 
 
 def train_faiss_index():
@@ -1,11 +1,17 @@
-from fastapi import FastAPI, HTTPException
-from typing import List
+from fastapi import FastAPI, HTTPException, Query
+from typing import Dict, List
 import logging
 from ML import query_faiss 
+from api.search_batcher import SearchBatcher
 import os
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 import boto3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key
 
 
@@ -15,57 +21,363 @@ logging.basicConfig(
 )
 app = FastAPI(title="AI Recommendation System", version="1.0")
 
-dynamodb = boto3.resource("dynamodb", region_name=os.getenv("AWS_DEFAULT_REGION"))
-interaction_table = dynamodb.Table(os.getenv("DYNAMODB_TABLE"))
+_thread_local = threading.local()
 
 TOP_K = int(os.getenv("TOP_K", 5))
-faiss_index = None
-itemid_to_index = {}
-index_to_itemid = {}
+# largest k a request may ask for; k beyond the neighbor table width falls back to live search
+MAX_K = int(os.getenv("MAX_K", 100))
+MAX_BATCH_USERS = int(os.getenv("MAX_BATCH_USERS", 1000))
+HISTORY_FETCH_WORKERS = int(os.getenv("HISTORY_FETCH_WORKERS", 32))
+USER_HISTORY_CACHE_SIZE = int(os.getenv("USER_HISTORY_CACHE_SIZE", 100000))
+USER_HISTORY_CACHE_TTL = float(os.getenv("USER_HISTORY_CACHE_TTL", 300))
+# GSI with partition key event_date and sort key event_timestamp (projecting user_id) that is
+# polled for new events to invalidate cached histories; unset leaves the TTL as the staleness bound
+USER_HISTORY_INVALIDATION_INDEX = os.getenv("USER_HISTORY_INVALIDATION_INDEX")
+USER_HISTORY_INVALIDATION_INTERVAL = float(os.getenv("USER_HISTORY_INVALIDATION_INTERVAL", 5))
+# seconds of event timestamps re-read per poll, covering ingest delay and clock skew
+USER_HISTORY_INVALIDATION_LAG = float(os.getenv("USER_HISTORY_INVALIDATION_LAG", 30))
+# 0 disables recency weighting and averages the history uniformly
+RECENCY_HALF_LIFE_DAYS = float(os.getenv("RECENCY_HALF_LIFE_DAYS", 0))
+# seconds between artifact version checks, 0 disables hot reload
+ARTIFACT_POLL_INTERVAL = float(os.getenv("ARTIFACT_POLL_INTERVAL", 60))
+# opt-in micro-batching of concurrent single-query FAISS searches
+SEARCH_BATCHING = os.getenv("SEARCH_BATCHING", "false").lower() == "true"
+SEARCH_BATCH_MAX_SIZE = int(os.getenv("SEARCH_BATCH_MAX_SIZE", 64))
+SEARCH_BATCH_MAX_WAIT_MS = float(os.getenv("SEARCH_BATCH_MAX_WAIT_MS", 2))
+# attempts at loading a generation whose pinned artifacts are overwritten mid-load by a new publish
+ARTIFACT_LOAD_ATTEMPTS = int(os.getenv("ARTIFACT_LOAD_ATTEMPTS", 5))
+
+
+class ModelGeneration:
+    """One consistent set of serving artifacts.
+
+    Generations are never mutated after loading. Requests take a reference
+    to the current generation once and use it throughout, so a hot reload
+    only swaps the module-level reference and in-flight requests finish on
+    the generation they started with.
+    """
+
+    def __init__(self, version, etag, faiss_index, item_vectors, id_map, neighbor_ids, neighbor_scores, rerank_factor=1, label_to_row=None):
+        self.version = version
+        self.etag = etag
+        self.faiss_index = faiss_index
+        self.rerank_factor = rerank_factor
+        # set when the index is labelled by item ID rather than row position
+        self.label_to_row = label_to_row
+        self.item_vectors = item_vectors
+        self.id_map = id_map
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_scores = neighbor_scores
+        self.loaded_at = time.time()
+
+
+def load_generation():
+    """Loads the artifacts pinned by the current manifest.
+
+    A publish that overwrites them while they are being fetched fails the
+    load with ArtifactChangedError; it is retried against the manifest that
+    publish writes, so a generation never mixes artifacts of two versions.
+    """
+    for attempt in range(1, max(1, ARTIFACT_LOAD_ATTEMPTS) + 1):
+        try:
+            return _load_generation()
+        except query_faiss.ArtifactChangedError as e:
+            if attempt >= ARTIFACT_LOAD_ATTEMPTS:
+                raise
+            logging.warning("Artifacts changed during load (%s), retrying (%d/%d).", e, attempt, ARTIFACT_LOAD_ATTEMPTS)
+            time.sleep(min(2 ** attempt, 30))
+
+
+def _load_generation():
+    # probed before reading the manifest, so a publish during the load is picked up by the next poll
+    etag = query_faiss.get_artifact_etag()
+    manifest = query_faiss.load_manifest()
+    settings = manifest or {}
+    faiss_index = query_faiss.apply_search_params(query_faiss.load_faiss_index(manifest), settings.get("search_params"))
+    item_ids, bundle_vectors = query_faiss.load_item_bundle(manifest)
+    item_vectors = query_faiss.load_item_vectors(faiss_index, bundle_vectors)
+    id_map = query_faiss.load_itemid_map(item_ids)
+    label_to_row = id_map.to_rows if settings.get("index_labels") == "itemid" else None
+    neighbor_ids, neighbor_scores = query_faiss.load_neighbor_table(manifest)
+    version = settings.get("version", etag)
+    logging.info("FAISS index and map loaded successfully (version %s).", version)
+    return ModelGeneration(
+        version, etag, faiss_index, item_vectors, id_map,
+        neighbor_ids, neighbor_scores, rerank_factor=settings.get("rerank_factor", 1), label_to_row=label_to_row,
+    )
+
+
+model = None
+search_batcher = None
+_reload_stop = threading.Event()
+
+
+def watch_artifacts():
+    """Polls the artifact version and swaps in a freshly loaded generation on change."""
+    global model
+    while not _reload_stop.wait(ARTIFACT_POLL_INTERVAL):
+        try:
+            etag = query_faiss.get_artifact_etag()
+            if etag is None or etag == model.etag:
+                continue
+            logging.info("Artifact change detected (%s -> %s), loading new generation.", model.etag, etag)
+            new_model = load_generation()
+            old_version, model = model.version, new_model
+            logging.info("Swapped model generation %s -> %s.", old_version, new_model.version)
+        except Exception as e:
+            # keep serving the current generation and retry on the next poll
+            logging.error("Artifact reload failed: %s", e, exc_info=True)
 
 @app.on_event("startup")
 def startup_event():
-    global faiss_index, itemid_to_index, index_to_itemid 
-    faiss_index = query_faiss.load_faiss_index()
-    maps = query_faiss.load_itemid_map()
-    itemid_to_index = maps["itemid_to_index"]
-    index_to_itemid = maps["index_to_itemid"]
-    logging.info("FAISS index and map loaded successfully.")
+    global model, search_batcher
+    model = load_generation()
+    if ARTIFACT_POLL_INTERVAL > 0:
+        threading.Thread(target=watch_artifacts, name="artifact-watcher", daemon=True).start()
+    if USER_HISTORY_INVALIDATION_INDEX and USER_HISTORY_INVALIDATION_INTERVAL > 0:
+        threading.Thread(target=watch_user_activity, name="user-activity-watcher", daemon=True).start()
+    if SEARCH_BATCHING:
+        search_batcher = SearchBatcher(SEARCH_BATCH_MAX_SIZE, SEARCH_BATCH_MAX_WAIT_MS)
+        logging.info("Search micro-batching enabled (max batch %d, max wait %.1f ms).", SEARCH_BATCH_MAX_SIZE, SEARCH_BATCH_MAX_WAIT_MS)
+
+@app.on_event("shutdown")
+def shutdown_event():
+    _reload_stop.set()
+    if search_batcher is not None:
+        search_batcher.close()
+
+def search_index(m, vectors, k):
+    """Searches the generation's index, routing single queries through the micro-batcher
+    when enabled and re-ranking exactly when the artifact asks for it."""
+    search_fn = None
+    if search_batcher is not None and vectors.shape[0] == 1:
+        search_fn = lambda queries, kk: search_batcher.search(m.faiss_index, queries, kk)
+    return query_faiss.search_with_rerank(m.faiss_index, m.item_vectors, vectors, k, m.rerank_factor, search_fn, m.label_to_row)
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok"}
+    current = model
+    return {
+        "status": "ok",
+        "model_version": current.version if current is not None else None,
+        "model_loaded_at": current.loaded_at if current is not None else None,
+        "user_history_cache": user_history_cache.stats(),
+    }
 
-@app.get("/recommend_user/{user_id}", response_model=List[str])
-def recommend_for_user(user_id: str, k: int = TOP_K):
-    try:
-        # Get user interaction history (latest 100 interactions)
-        response = interaction_table.query(
+class UserHistoryCache:
+    """Bounded LRU cache with a per-entry TTL for user interaction histories.
+
+    Entries are evicted least-recently-used first once maxsize is reached and
+    expire ttl seconds after they were stored. Safe to share across threads.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+user_history_cache = UserHistoryCache(USER_HISTORY_CACHE_SIZE, USER_HISTORY_CACHE_TTL)
+
+def get_table():
+    table = getattr(_thread_local, "table", None)
+    if table is None:
+        # boto3 resources are not thread-safe, so each worker thread gets its own
+        table = boto3.resource("dynamodb", region_name=os.getenv("AWS_DEFAULT_REGION")).Table(os.getenv("DYNAMODB_TABLE"))
+        _thread_local.table = table
+    return table
+
+def query_user_history(user_id):
+    """Reads the user's most recent interactions (latest 100) from DynamoDB, newest first.
+
+    Only itemid and event_timestamp are projected, and the result is kept as a
+    list of (itemid, event_timestamp) tuples.
+    """
+    response = get_table().query(
         IndexName="user_id-index",
         KeyConditionExpression=Key("user_id").eq(user_id),
+        ProjectionExpression="itemid, event_timestamp",
         Limit=100,
         ScanIndexForward=False  # Recent first
-        )
-        items = response.get("Items", [])
+    )
+    return [(str(item["itemid"]), item.get("event_timestamp")) for item in response.get("Items", []) if "itemid" in item]
+
+def recently_active_users(since):
+    """user_ids with events timestamped after since (naive UTC), read from the event_date GSI."""
+    table = get_table()
+    users = set()
+    day, today = since.date(), datetime.utcnow().date()
+    while day <= today:
+        kwargs = {
+            "IndexName": USER_HISTORY_INVALIDATION_INDEX,
+            "KeyConditionExpression": Key("event_date").eq(day.isoformat()) & Key("event_timestamp").gt(since.isoformat()),
+            "ProjectionExpression": "user_id",
+        }
+        while True:
+            response = table.query(**kwargs)
+            users.update(str(item["user_id"]) for item in response.get("Items", []) if "user_id" in item)
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        day += timedelta(days=1)
+    return users
+
+def watch_user_activity():
+    """Drops cached histories of users with freshly ingested events.
+
+    The events table is the shared channel: every worker process polls it
+    independently, so all of them converge within one poll interval instead
+    of the cache TTL.
+    """
+    since = datetime.utcnow() - timedelta(seconds=USER_HISTORY_INVALIDATION_LAG)
+    while not _reload_stop.wait(USER_HISTORY_INVALIDATION_INTERVAL):
+        now = datetime.utcnow()
+        try:
+            users = recently_active_users(since)
+            for user_id in users:
+                user_history_cache.invalidate(user_id)
+            since = now - timedelta(seconds=USER_HISTORY_INVALIDATION_LAG)
+        except Exception as e:
+            # cached entries still expire through the TTL; retry on the next poll
+            logging.error("User history invalidation poll failed: %s", e, exc_info=True)
+
+def get_user_history(user_id):
+    """Returns the cached user history, querying DynamoDB on a miss."""
+    history = user_history_cache.get(user_id)
+    if history is None:
+        history = query_user_history(user_id)
+        user_history_cache.put(user_id, history)
+    return history
+
+def get_history_rows(m, history):
+    """Returns the embedding rows and recency weights of a user's known items."""
+    rows = m.id_map.to_rows([item_id for item_id, _ in history])
+    known = rows >= 0
+    weights = query_faiss.recency_weights([ts for (_, ts), ok in zip(history, known) if ok], RECENCY_HALF_LIFE_DAYS)
+    return rows[known], weights
+
+def filter_seen(m, indices, seen_rows, k):
+    """Maps FAISS result rows to itemids, dropping padding and already seen items."""
+    rows = indices[(indices >= 0) & ~np.isin(indices, seen_rows)][:k]
+    return m.id_map.to_ids(rows).astype(str).tolist()
+
+@app.get("/recommend_user/{user_id}", response_model=List[str])
+def recommend_for_user(user_id: str, k: int = Query(TOP_K, ge=1, le=MAX_K)):
+    m = model
+    try:
+        # Get user interaction history (latest 100 interactions)
+        items = get_user_history(user_id)
         if not items:
             raise HTTPException(status_code=404, detail="No interactions found for this user")
 
         # Get valid itemids the user has interacted with
-        item_ids = [str(item["itemid"]) for item in items if str(item["itemid"]) in itemid_to_index]
-        if not item_ids:
+        rows, weights = get_history_rows(m, items)
+        if not len(rows):
             raise HTTPException(status_code=404, detail="No valid item embeddings for this user")
 
-        # Get vectors of those items and average them
-        user_vectors = [faiss_index.reconstruct(itemid_to_index[item]) for item in item_ids]
-        user_vector = np.mean(user_vectors, axis=0).reshape(1, -1)
+        # Weighted average of the history vectors
+        user_vector = query_faiss.build_user_vectors(m.item_vectors, [rows], [weights])
 
         # Query FAISS with user vector
-        scores, indices = faiss_index.search(user_vector, k + len(item_ids))
+        scores, indices = search_index(m, user_vector, k + len(rows))
 
         # Filter out previously seen items
-        recommendations = [index_to_itemid[i] for i in indices[0] if index_to_itemid[i] not in item_ids]
-        logging.info(f"Recommended for user {user_id}: {recommendations[:k]}")
-        return recommendations[:k]
+        recommendations = filter_seen(m, indices[0], rows, k)
+        logging.info(f"Recommended for user {user_id}: {recommendations}")
+        return recommendations
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+class RecommendUsersRequest(BaseModel):
+    user_ids: List[str]
+    k: int = Field(TOP_K, ge=1, le=MAX_K)
+
+@app.post("/recommend_users", response_model=Dict[str, List[str]])
+def recommend_for_users(request: RecommendUsersRequest):
+    """Recommends for many users with concurrent history reads and one batched FAISS search.
+
+    Users without history or without known items map to an empty list.
+    """
+    m = model
+    user_ids = list(dict.fromkeys(request.user_ids))
+    if len(user_ids) > MAX_BATCH_USERS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_USERS} user IDs per request")
+    try:
+        with ThreadPoolExecutor(max_workers=HISTORY_FETCH_WORKERS) as executor:
+            histories = list(executor.map(get_user_history, user_ids))
+
+        results = {user_id: [] for user_id in user_ids}
+        query_users = []
+        query_rows = []
+        query_weights = []
+        for user_id, items in zip(user_ids, histories):
+            rows, weights = get_history_rows(m, items)
+            if len(rows):
+                query_users.append(user_id)
+                query_rows.append(rows)
+                query_weights.append(weights)
+        if not query_users:
+            return results
+
+        # One (n_users x d) query matrix and a single search for the whole batch
+        query_matrix = query_faiss.build_user_vectors(m.item_vectors, query_rows, query_weights)
+        max_seen = max(len(rows) for rows in query_rows)
+        scores, indices = search_index(m, query_matrix, request.k + max_seen)
+
+        for row, user_id in enumerate(query_users):
+            results[user_id] = filter_seen(m, indices[row], query_rows[row], request.k)
+        logging.info(f"Recommended for {len(query_users)}/{len(user_ids)} users in one batch.")
+        return results
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/recommend/{item_id}", response_model=List[str])
+def recommend_similar_items(item_id: str, k: int = Query(TOP_K, ge=1, le=MAX_K)):
+    m = model
+    if item_id not in m.id_map:
+        raise HTTPException(status_code=404, detail="Item ID not found")
+    try:
+        # O(1) lookup in the precomputed table, live search for newer items
+        similar_items = query_faiss.get_similar_items_from_table(item_id, m.neighbor_ids, m.id_map, k)
+        if similar_items is None:
+            similar_items = query_faiss.get_similar_items(
+                item_id, m.faiss_index, m.id_map, k, m.item_vectors,
+                search_fn=lambda vectors, kk: search_index(m, vectors, kk),
+            )
+        return similar_items
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,79 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class SearchBatcher:
+    """Coalesces concurrent single-query FAISS searches into batched calls.
+
+    Request threads call search() and block on a future while a worker thread
+    collects queries for up to max_wait_ms (or until max_batch_size queries
+    are queued), runs one search per index with the largest requested k and
+    hands each caller back its own rows truncated to its k.
+    """
+
+    def __init__(self, max_batch_size=64, max_wait_ms=2.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="search-batcher", daemon=True)
+        self._thread.start()
+
+    def search(self, index, vectors, k):
+        """Same contract as index.search for a (1 x d) float32 query."""
+        future = Future()
+        self._queue.put((index, np.asarray(vectors, dtype=np.float32).reshape(1, -1), k, future))
+        return future.result()
+
+    def close(self):
+        self._stop.set()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stop.set()
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            # requests may target different model generations during a hot reload
+            groups = {}
+            for request in batch:
+                groups.setdefault(id(request[0]), []).append(request)
+            for requests in groups.values():
+                self._search_group(requests)
+
+    def _search_group(self, requests):
+        index = requests[0][0]
+        k_max = max(k for _, _, k, _ in requests)
+        try:
+            scores, indices = index.search(np.vstack([vectors for _, vectors, _, _ in requests]), k_max)
+        except Exception as e:
+            logging.error("Batched FAISS search failed: %s", e)
+            for _, _, _, future in requests:
+                future.set_exception(e)
+            return
+        for row, (_, _, k, future) in enumerate(requests):
+            future.set_result((scores[row:row + 1, :k], indices[row:row + 1, :k]))
@@ -6,8 +6,10 @@ from ML.build_training_dataset import build_training_dataset
 from scripts.s3_to_dynamodb import s3_to_dynamodb
 from ML.item_embeddings import generate_item_embeddings
 from ML.train_faiss_index import train_faiss_index
+from ML.build_neighbor_table import build_neighbor_table
 from scripts.prepare_evaluation_data import prepare_evaluation_data
 from scripts.offline_evaluation import run_offline_evaluation
+from ML.benchmark_faiss_index import benchmark_faiss_index
 
 
 # Mapping of pipeline steps to functions
@@ -16,7 +18,8 @@ PIPELINE_STEPS = {
     "s3_to_dynamodb": s3_to_dynamodb,
     "build_training_dataset": build_training_dataset,
     "generate_item_embeddings": generate_item_embeddings,
-    "train_faiss_index": train_faiss_index
+    "train_faiss_index": train_faiss_index,
+    "build_neighbor_table": build_neighbor_table
 }
 
 EVAL_STEPS = {
@@ -24,8 +27,14 @@ EVAL_STEPS = {
     "offline_evaluation": run_offline_evaluation
 }
 
+# Standalone tuning steps, not part of "all" or "eval"
+TUNING_STEPS = {
+    "benchmark_faiss_index": benchmark_faiss_index
+}
+
 ALL_STEPS = list(PIPELINE_STEPS.keys())
 ALL_EVAL = list(EVAL_STEPS.keys())
+ALL_TUNING = list(TUNING_STEPS.keys())
 
 # Logging setup
 logging.basicConfig(
@@ -39,7 +48,7 @@ def main():
     parser = argparse.ArgumentParser(description="Run AI Recommendation System Pipeline")
     parser.add_argument(
         "step",
-        choices=["all", "eval"] + ALL_STEPS + ALL_EVAL,
+        choices=["all", "eval"] + ALL_STEPS + ALL_EVAL + ALL_TUNING,
         help="Pipeline step to run. Use 'all' to run full pipeline or 'eval' to run evaluation suite."
     )
     parser.add_argument("--stop-on-fail", action="store_true", help="Stop the pipeline if any step fails.")
@@ -65,6 +74,8 @@ def main():
             PIPELINE_STEPS[args.step]()
         elif args.step in EVAL_STEPS:
             EVAL_STEPS[args.step]()
+        elif args.step in TUNING_STEPS:
+            TUNING_STEPS[args.step]()
         else:
             parser.print_help()
     except Exception as e:
@@ -8,6 +8,14 @@ dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ['DYNAMODB_TABLE'])
 
 
+def event_date_of(timestamp):
+    """YYYY-MM-DD day of an ISO timestamp, "unknown" if it does not start with a valid date."""
+    try:
+        return datetime.strptime(str(timestamp)[:10], "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        return "unknown"
+
+
 def lambda_handler(event, context):
     try: 
         print("Received event:", event)
@@ -32,6 +40,7 @@ def lambda_handler(event, context):
             'property': property,
             'value': value,
             'event_timestamp': event_timestamp,
+            'event_date': event_date_of(event_timestamp),  # partition key of the incremental export GSI
             'item_timestamp': item_timestamp
         }
         
@@ -1,10 +1,15 @@
 import os
 import json
 import logging
+import random
+import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from decimal import Decimal
-import uuid
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from ML.event_batches import iter_batch_events, is_batch_key, to_table_item
 
 # Setup logging
 logging.basicConfig(
@@ -16,11 +21,27 @@ REGION = os.getenv("AWS_REGION", "us-east-1")
 TABLE_NAME = os.getenv("DYNAMODB_TABLE", "user_interactions")
 S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
 IMPORT_PREFIX = os.getenv("IMPORT_PREFIX", "batches")
+# batches imported concurrently, each by its own batch writer
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", 8))
+# one marker object per completed batch, named after its key, so a restarted import skips finished work
+IMPORT_CHECKPOINT_PREFIX = os.getenv("IMPORT_CHECKPOINT_PREFIX", "import_state/completed")
+# single JSON list of completed keys written by earlier versions; still honored when present
+LEGACY_CHECKPOINT_KEY = "import_state/completed_batches.json"
+# backoff for throttled requests and unprocessed items, in seconds
+IMPORT_BACKOFF_BASE = float(os.getenv("IMPORT_BACKOFF_BASE", 0.1))
+IMPORT_BACKOFF_MAX = float(os.getenv("IMPORT_BACKOFF_MAX", 20))
+IMPORT_MAX_RETRIES = int(os.getenv("IMPORT_MAX_RETRIES", 10))
+# records DynamoDB rejects are written here, one object per source batch, and the import moves on
+IMPORT_DEAD_LETTER_PREFIX = os.getenv("IMPORT_DEAD_LETTER_PREFIX", "import_state/dead_letter")
 
-# Init AWS clients
-dynamodb = boto3.resource('dynamodb', region_name=REGION)
+# DynamoDB accepts at most 25 puts per BatchWriteItem call
+BATCH_WRITE_LIMIT = 25
+THROTTLING_ERRORS = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+
+# Init AWS clients (clients, unlike resources, are safe to share between threads)
+dynamodb = boto3.client('dynamodb', region_name=REGION)
 s3 = boto3.client('s3', region_name=REGION)
-table = dynamodb.Table(TABLE_NAME)
+serializer = TypeSerializer()
 
 def parse_json_number(value):
     if isinstance(value, float) or isinstance(value, int):
@@ -34,57 +55,183 @@ def parse_json_number(value):
 
 def list_s3_batches():
     logging.info(f"Listing batches in S3 bucket '{S3_BUCKET}' with prefix '{IMPORT_PREFIX}'")
-    objects = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=IMPORT_PREFIX)
-    return [obj['Key'] for obj in objects.get('Contents', []) if obj['Key'].endswith('.json')]
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=IMPORT_PREFIX):
+        for obj in page.get('Contents', []):
+            if is_batch_key(obj['Key']):
+                yield obj['Key']
 
 def load_batch_from_s3(s3_key):
+    """Streams the events of one batch (JSON or NDJSON, optionally compressed) from the S3 response body."""
     logging.info(f"Loading batch from S3: {s3_key}")
     response = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
-    data = response['Body'].read().decode('utf-8')
-    return json.loads(data, parse_float=Decimal)
+    return iter_batch_events(response['Body'])
 
-def write_to_dynamodb(events):
-    logging.info(f"Writing {len(events)} events to DynamoDB table '{TABLE_NAME}'")
-    with table.batch_writer() as batch:
-        for item in events:
+def to_put_request(event):
+    item = to_table_item(event)
+    if item is None:
+        logging.warning(f"Missing user_id, skipping item: {event}")
+        return None
+    item = {k: parse_json_number(v) for k, v in item.items()}
+    return {"PutRequest": {"Item": {k: serializer.serialize(v) for k, v in item.items()}}}
+
+def backoff(attempt):
+    time.sleep(min(IMPORT_BACKOFF_MAX, IMPORT_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1))
+
+def put_items(requests):
+    """Puts items one by one after DynamoDB rejected their whole chunk; returns the rejected [(item, error)]."""
+    rejected = []
+    for request in requests:
+        item = request["PutRequest"]["Item"]
+        for attempt in range(IMPORT_MAX_RETRIES + 1):
             try:
-                item = {k: parse_json_number(v) for k, v in item.items()}
+                dynamodb.put_item(TableName=TABLE_NAME, Item=item)
+                break
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code == "ValidationException":
+                    rejected.append((item, str(e)))
+                    break
+                if code not in THROTTLING_ERRORS or attempt == IMPORT_MAX_RETRIES:
+                    raise
+                backoff(attempt)
+    return rejected
+
+def batch_write(requests):
+    """One BatchWriteItem call, resubmitting unprocessed items with exponential backoff.
+
+    A ValidationException rejects the whole chunk for a single bad item, so
+    the chunk is then written item by item. Returns the rejected [(item, error)].
+    """
+    for attempt in range(IMPORT_MAX_RETRIES + 1):
+        try:
+            response = dynamodb.batch_write_item(RequestItems={TABLE_NAME: requests})
+            requests = response.get("UnprocessedItems", {}).get(TABLE_NAME, [])
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ValidationException":
+                return put_items(requests)
+            if e.response["Error"]["Code"] not in THROTTLING_ERRORS:
+                raise
+        if not requests:
+            return []
+        backoff(attempt)
+    raise RuntimeError(f"{len(requests)} items still unprocessed after {IMPORT_MAX_RETRIES} retries.")
+
+def write_to_dynamodb(events):
+    """Writes events in BatchWriteItem chunks; returns (number written, rejected [(record, error)]).
+
+    Event IDs are derived from the event content, so re-importing a batch
+    overwrites the same items instead of adding duplicates. Identical events
+    within a chunk collapse to one put, as DynamoDB rejects duplicate keys
+    in a single request. Events that cannot be serialized or that DynamoDB
+    rejects are returned instead of failing the batch.
+    """
+    written = 0
+    rejected = []
+    chunk = {}
+
+    def flush():
+        failed = batch_write(list(chunk.values()))
+        rejected.extend(failed)
+        return len(chunk) - len(failed)
+
+    for event in events:
+        try:
+            request = to_put_request(event)
+        except (TypeError, ValueError) as e:  # e.g. NaN or Infinity, which DynamoDB cannot store
+            rejected.append((event, str(e)))
+            continue
+        if request is None:
+            continue
+        chunk[request["PutRequest"]["Item"]["event_id"]["S"]] = request
+        if len(chunk) == BATCH_WRITE_LIMIT:
+            written += flush()
+            chunk = {}
+    if chunk:
+        written += flush()
+    return written, rejected
 
-                # Ensure user_id exists
-                if "user_id" not in item:
-                    logging.warning(f"Missing user_id, skipping item: {item}")
-                    continue
+def dead_letter_key(s3_key):
+    return f"{IMPORT_DEAD_LETTER_PREFIX}/{s3_key}.json"
 
-                item['user_id'] = str(item['user_id'])         # required for GSI
-                item['event_id'] = str(uuid.uuid4())           # required as PK
+def write_dead_letters(s3_key, rejected):
+    """Saves a batch's rejected records with their errors; a rerun of the batch overwrites the object."""
+    records = [{"record": record, "error": error} for record, error in rejected]
+    body = json.dumps({"source": s3_key, "records": records, "updated_at": datetime.now().isoformat()}, default=str)
+    s3.put_object(Bucket=S3_BUCKET, Key=dead_letter_key(s3_key), Body=body.encode("utf-8"))
+    logging.warning(f"{len(rejected)} records of {s3_key} were rejected and written to s3://{S3_BUCKET}/{dead_letter_key(s3_key)}; "
+                    f"first error: {rejected[0][1]}")
 
-                # Optionally ensure timestamp is string or datetime
-                if "event_timestamp" in item:
-                    item["event_timestamp"] = str(item["event_timestamp"])
+class Checkpoint:
+    """Completed batch keys: listed from their marker objects at start-up, one marker written per completion.
 
-                batch.put_item(Item=item)
+    Each completion is a single small put, so the cost of checkpointing
+    stays linear in the number of batches.
+    """
 
-            except Exception as e:
-                logging.warning(f"Failed to write item: {item.get('user_id', 'UNKNOWN')}, error: {e}")
-    logging.info(f"Successfully wrote {len(events)} events to DynamoDB.")
+    def __init__(self, prefix=IMPORT_CHECKPOINT_PREFIX):
+        self.prefix = prefix.rstrip("/")
+        self.completed = set()
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{self.prefix}/"):
+            for obj in page.get('Contents', []):
+                self.completed.add(obj['Key'][len(self.prefix) + 1:-len(".json")])
+        try:
+            body = s3.get_object(Bucket=S3_BUCKET, Key=LEGACY_CHECKPOINT_KEY)['Body'].read()
+            self.completed.update(json.loads(body)["completed"])
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
 
-def s3_to_dynamodb():
-    logging.info("Starting S3 to DynamoDB import")
+    def __contains__(self, s3_key):
+        return s3_key in self.completed
+
+    def marker_key(self, s3_key):
+        return f"{self.prefix}/{s3_key}.json"
+
+    def add(self, s3_key, written):
+        body = json.dumps({"written": written, "completed_at": datetime.now().isoformat()})
+        s3.put_object(Bucket=S3_BUCKET, Key=self.marker_key(s3_key), Body=body.encode("utf-8"))
+
+def import_batch(s3_key, checkpoint):
+    try:
+        written, rejected = write_to_dynamodb(load_batch_from_s3(s3_key))
+        if rejected:
+            write_dead_letters(s3_key, rejected)
+        checkpoint.add(s3_key, written)
+    except Exception as e:
+        logging.error(f"Failed to import batch {s3_key}: {e}")
+        return None
+    logging.info(f"Wrote {written} events from {s3_key} to DynamoDB table '{TABLE_NAME}'.")
+    return written
+
+def s3_to_dynamodb(workers=IMPORT_WORKERS):
+    logging.info(f"Starting S3 to DynamoDB import with {workers} workers")
     start_time = datetime.now()
-    
+
     try:
-        s3_batches = list_s3_batches()
-        if not s3_batches:
+        checkpoint = Checkpoint()
+        skipped = 0
+        futures = []
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="import") as executor:
+            try:
+                for s3_key in list_s3_batches():
+                    if s3_key in checkpoint:
+                        skipped += 1
+                        continue
+                    futures.append(executor.submit(import_batch, s3_key, checkpoint))
+            finally:
+                results = [future.result() for future in futures]
+
+        if not futures and not skipped:
             logging.warning("No batches found in S3.")
             return
-        
-        for s3_key in s3_batches:
-            events = load_batch_from_s3(s3_key)
-            write_to_dynamodb(events)
-        
+        failed = sum(result is None for result in results)
+        logging.info(f"Imported {len(results) - failed} batches ({sum(r for r in results if r)} events), "
+                     f"skipped {skipped} already imported, {failed} failed.")
         duration = (datetime.now() - start_time).total_seconds()
-        logging.info(f"Import completed successfully in {duration:.2f} seconds.")
-        
+        logging.info(f"Import completed in {duration:.2f} seconds.")
+
     except Exception as e:
         logging.error(f"Error during import: {e}", exc_info=True)
 
@@ -3,17 +3,21 @@ import requests
 import time
 import logging
 import os
-from datetime import datetime
-import math
+from datetime import datetime, timezone
+import numpy as np
 import boto3
+import io
 import json
 import uuid
+from ML.event_batches import encode_batch
 
 # Configuration
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
 S3_BUCKET = os.getenv("S3_BUCKET", "ecom-raw-events")
 EXPORT_PREFIX = os.getenv("EXPORT_PREFIX", "batches")
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 2000))
+# NDJSON compression: "auto" (zstd if installed, else gzip), "zstd", "gzip" or "none"; "json" keeps the legacy JSON array
+BATCH_FORMAT = os.getenv("BATCH_FORMAT", "auto")
 
 # AWS Clients
 s3 = boto3.client("s3", region_name=AWS_REGION)
@@ -33,50 +37,88 @@ def get_item_features():
     item_features.columns.name = None
     return item_features
 
-def safe_timestamp(ts):
-    try:
-        ts = float(ts)
-        if ts < 0 or ts > 4102444800:  # Year 2100-ish
-            return "INVALID_TIMESTAMP"
-        return datetime.fromtimestamp(ts).isoformat()
-    except (ValueError, TypeError):
-        return "INVALID_TIMESTAMP"
-
-
-def to_event(row):
-    """Converts a DataFrame row to a JSON event."""
-    event = {
-        "user_id": str(row["visitorid"]),
-        "item_id": str(row["itemid"]),
-        "event": row["event"],
-        "property": row.get("property", None),
-        "value": row.get("value", None),
-        "event_timestamp": safe_timestamp(row["event_timestamp"]),
-        "item_timestamp": safe_timestamp(row.get("item_timestamp", 0)) if "item_timestamp" in row else None
+# Timestamps outside [0, MAX_TIMESTAMP] seconds are reported as INVALID_TIMESTAMP
+MAX_TIMESTAMP = 4102444800  # Year 2100-ish
+
+def local_offsets(seconds):
+    """UTC offsets (seconds) of the local timezone at each epoch second.
+
+    Offsets only change on quarter-hour boundaries, so they are looked up
+    once per distinct quarter hour rather than once per event.
+    """
+    quarters, inverse = np.unique(seconds // 900 * 900, return_inverse=True)
+    offsets = np.array([
+        (datetime.fromtimestamp(q) - datetime.fromtimestamp(q, timezone.utc).replace(tzinfo=None)).total_seconds()
+        for q in quarters
+    ])
+    return offsets[inverse]
+
+def safe_timestamps(values):
+    """Formats epoch seconds as local-time ISO strings for a whole column at once.
+
+    Matches datetime.fromtimestamp(ts).isoformat(): microseconds are only
+    shown when non-zero, and non-numeric or out-of-range values become
+    "INVALID_TIMESTAMP".
+    """
+    seconds = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float)
+    valid = (seconds >= 0) & (seconds <= MAX_TIMESTAMP)
+    result = np.full(len(seconds), "INVALID_TIMESTAMP", dtype=object)
+    if valid.any():
+        local = pd.to_datetime(seconds[valid] + local_offsets(seconds[valid]), unit="s").round("us")
+        text = np.datetime_as_string(local.to_numpy().astype("datetime64[us]"), unit="us")
+        result[valid] = pd.Series(text).str.removesuffix(".000000").to_numpy()
+    return result
+
+def with_sentinels(column):
+    """Replaces float NaN/Inf values with the "nNaN"/"nInf"/"n-Inf" sentinels; other values are kept."""
+    if column.dtype.kind not in "fO":
+        return column
+    values = column.to_numpy(dtype=object)
+    nan = pd.isna(values) & (values != None)  # None stays null, as before
+    pos_inf = values == np.inf
+    neg_inf = values == -np.inf
+    if not (nan.any() or pos_inf.any() or neg_inf.any()):
+        return column
+    values = values.copy()
+    values[nan] = "nNaN"
+    values[pos_inf] = "nInf"
+    values[neg_inf] = "n-Inf"
+    return pd.Series(values, index=column.index, dtype=object)
+
+def to_events(frame):
+    """Converts a DataFrame of events to JSON events.
+
+    Every field is converted as a whole column; records are only assembled
+    at the end, from plain Python lists.
+    """
+    missing = [None] * len(frame)
+    columns = {
+        "user_id": frame["visitorid"].astype(str).tolist(),
+        "item_id": frame["itemid"].astype(str).tolist(),
+        "event": frame["event"].tolist(),
+        "property": frame["property"].tolist() if "property" in frame else missing,
+        "value": frame["value"].tolist() if "value" in frame else missing,
+        "event_timestamp": safe_timestamps(frame["event_timestamp"]).tolist(),
+        "item_timestamp": safe_timestamps(frame["item_timestamp"]).tolist() if "item_timestamp" in frame else missing,
     }
     # Handle additional columns dynamically
-    for col in row.index: 
-        if col not in event:  
-            val = row[col] 
-            if isinstance(val, float) and not isinstance(val, str): 
-                if math.isnan(val):
-                    val = "nNaN"
-                elif math.isinf(val):
-                    val = "nInf" if val > 0 else "n-Inf"
-            event[col] = val 
-    return event
+    for col in frame.columns:
+        if col not in columns:
+            columns[col] = with_sentinels(frame[col]).tolist()
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
 
 def save_batch_to_s3(batch_data):
     timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    filename = f"batch_{timestamp}_{uuid.uuid4().hex}.json"
-    file_path = f"/tmp/{filename}"
-
-    with open(file_path, "w") as f:
-        json.dump(batch_data, f, indent=2)
+    if BATCH_FORMAT == "json":
+        payload, suffix = json.dumps(batch_data, indent=2).encode("utf-8"), ".json"
+    else:
+        payload, suffix = encode_batch(batch_data, BATCH_FORMAT)
 
-    s3_key = f"{EXPORT_PREFIX}/{filename}"
-    s3.upload_file(file_path, S3_BUCKET, s3_key)
-    logging.info(f"Uploaded batch of {len(batch_data)} events to s3://{S3_BUCKET}/{s3_key}")
+    # uploaded straight from memory, no local temp file
+    s3_key = f"{EXPORT_PREFIX}/batch_{timestamp}_{uuid.uuid4().hex}{suffix}"
+    s3.upload_fileobj(io.BytesIO(payload), S3_BUCKET, s3_key)
+    logging.info(f"Uploaded batch of {len(batch_data)} events ({len(payload)} bytes) to s3://{S3_BUCKET}/{s3_key}")
 
 def stream_events_to_s3(item_features):
     event_iterator = pd.read_csv("retailrocket_data/events.csv", chunksize=CHUNK_SIZE)
@@ -85,7 +127,7 @@ def stream_events_to_s3(item_features):
         chunk['event_timestamp'] = chunk["event_timestamp"] / 1000
         merged_chunk = chunk.merge(item_features, how="left", on="itemid")
 
-        events = [to_event(row) for _, row in merged_chunk.iterrows()]
+        events = to_events(merged_chunk)
         save_batch_to_s3(events)
         logging.info(f"Processed and saved chunk of {len(events)} events.")
         
@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# pipeline modules read their configuration and create AWS clients at import time
+_work_dir = tempfile.mkdtemp(prefix="recommender-tests-")
+for _name in ("BUNDLE_WORK_DIR", "ARTIFACT_DIR", "EMBEDDING_WORK_DIR"):
+    os.environ.setdefault(_name, os.path.join(_work_dir, _name.lower()))
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
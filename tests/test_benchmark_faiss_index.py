@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from ML import benchmark_faiss_index as benchmark
+
+
+def test_split_queries_holds_out_a_tenth():
+    database, queries = benchmark.split_queries(np.arange(200, dtype=np.float32).reshape(100, 2), 1000)
+    assert queries.shape == (10, 2) and database.shape == (90, 2)
+
+
+def test_split_queries_keeps_one_query_for_small_catalogs():
+    database, queries = benchmark.split_queries(np.arange(10, dtype=np.float32).reshape(5, 2), 1000)
+    assert queries.shape == (1, 2) and database.shape == (4, 2)
+    with pytest.raises(ValueError):
+        benchmark.split_queries(np.zeros((1, 2), dtype=np.float32), 1000)
@@ -0,0 +1,96 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from ML import build_training_dataset as dataset
+
+
+@pytest.fixture
+def state_store(monkeypatch):
+    """Keeps the export's JSON state objects in a dict instead of S3."""
+    store = {}
+    monkeypatch.setattr(dataset, "read_json", lambda key: store.get(key))
+    monkeypatch.setattr(dataset, "write_json", lambda key, data: store.__setitem__(key, data))
+    return store
+
+
+def watermark(store):
+    return (store.get(dataset.watermark_key()) or {}).get("event_timestamp")
+
+
+def test_finish_export_advances_to_newest_parseable_timestamp(state_store):
+    states = [
+        {"count": 2, "max_event_timestamp": "2024-01-02T10:00:00"},
+        {"count": 1, "max_event_timestamp": "INVALID_TIMESTAMP"},
+        {"count": 0, "max_event_timestamp": None},
+        {"count": 3, "max_event_timestamp": "2024-01-03T00:00:00+02:00"},
+    ]
+    dataset.finish_export({"export_id": "e1"}, states)
+
+    assert watermark(state_store) == "2024-01-02T22:00:00"
+    export = state_store[f"{dataset.SCAN_STATE_PREFIX}/export.json"]
+    assert export["done"] and export["count"] == 6
+
+
+def test_finish_export_never_moves_the_watermark_back(state_store):
+    dataset.finish_export({"export_id": "e1"}, [{"count": 1, "max_event_timestamp": "2024-05-01T00:00:00"}])
+    dataset.finish_export({"export_id": "e2"}, [{"count": 1, "max_event_timestamp": "2024-04-01T00:00:00"}])
+    assert watermark(state_store) == "2024-05-01T00:00:00"
+    assert state_store[dataset.watermark_key()]["export_id"] == "e1"
+
+
+def test_finish_export_without_parseable_timestamps_keeps_no_watermark(state_store):
+    dataset.finish_export({"export_id": "e1"}, [{"count": 1, "max_event_timestamp": "INVALID_TIMESTAMP"}])
+    assert dataset.watermark_key() not in state_store
+
+
+def test_read_watermark_rejects_unparseable_value(state_store):
+    state_store[dataset.watermark_key()] = {"event_timestamp": "INVALID_TIMESTAMP"}
+    with pytest.raises(ValueError):
+        dataset.read_watermark()
+
+
+def test_export_since_applies_the_lag(state_store, monkeypatch):
+    monkeypatch.setattr(dataset, "WATERMARK_LAG_SECONDS", 60)
+    assert dataset.export_since("incremental") is None
+    state_store[dataset.watermark_key()] = {"event_timestamp": "2024-01-02T00:00:00"}
+    assert dataset.export_since("incremental") == "2024-01-01T23:59:00"
+    assert dataset.export_since("full") is None
+
+
+def test_newest_event_time_skips_unparseable_values():
+    values = ["2024-01-01T00:00:00", "INVALID_TIMESTAMP", None, "2024-01-01T12:00:00.5"]
+    assert dataset.newest_event_time(values) == "2024-01-01T12:00:00.500000"
+    assert dataset.newest_event_time(["INVALID_TIMESTAMP"]) is None
+    assert dataset.latest_event_time("2024-01-01", None, "bad") == pd.Timestamp("2024-01-01").isoformat()
+
+
+def test_merged_schema_turns_mixed_columns_into_strings():
+    first = pa.table({"event_id": ["a"], "price": [1.5], "color": pa.nulls(1)})
+    second = pa.table({"event_id": ["b"], "price": ["cheap"], "color": ["red"]})
+    schema = dataset.merged_schema([first.schema, second.schema])
+    assert schema.field("price").type == pa.string()
+    assert schema.field("color").type == pa.string()
+
+    merged = pa.concat_tables([dataset.conform(table, schema) for table in (first, second)])
+    assert merged.column("price").to_pylist() == ["1.5", "cheap"]
+    assert dataset.conform(pa.table({"event_id": ["c"]}), schema).column("color").to_pylist() == [None]
+
+
+def test_delete_uncommitted_parts_keeps_committed_and_other_exports(state_store, monkeypatch):
+    keys = [
+        dataset.part_filename("e1", 0, 0, "2024-01-01"),
+        dataset.part_filename("e1", 0, 1, "2024-01-01"),
+        dataset.part_filename("e1", 0, 2, "2024-01-02"),
+        dataset.part_filename("e1", 1, 0, "unknown"),
+        dataset.part_filename("e0", 0, 5, "2024-01-01"),
+        dataset.merged_filename(f"{dataset.OUTPUT_PREFIX}/event_date=2024-01-01", "e1"),
+    ]
+    deleted = []
+    monkeypatch.setattr(dataset, "list_keys", lambda prefix: iter(keys))
+    monkeypatch.setattr(dataset, "delete_keys", deleted.extend)
+    state_store[dataset.segment_state_key(0)] = {"export_id": "e1", "part": 1}
+    state_store[dataset.segment_state_key(1)] = {"export_id": "e0", "part": 3}
+
+    dataset.delete_uncommitted_parts("e1")
+    assert deleted == [keys[1], keys[2], keys[3]]
@@ -0,0 +1,76 @@
+import io
+import json
+import gzip
+from decimal import Decimal
+
+import pytest
+
+from ML.event_batches import (
+    encode_batch, event_date_of, event_id_for, is_batch_key, iter_batch_events, iter_json_array, to_table_item,
+)
+
+EVENTS = [
+    {"user_id": 1, "itemid": 10, "event": "view", "price": Decimal("1.5"), "event_timestamp": "2024-01-01T00:00:00"},
+    {"user_id": "2", "itemid": 11, "event": "addtocart", "note": "a, b ] {c}", "event_timestamp": "2024-01-02T10:00:00"},
+    {"user_id": 3, "itemid": 12, "event": "transaction", "nested": {"k": [1, 2]}, "event_timestamp": "INVALID_TIMESTAMP"},
+]
+
+
+def test_event_id_is_deterministic_and_key_order_independent():
+    event = {"user_id": 1, "itemid": 10, "price": Decimal("1.5")}
+    reordered = {"price": Decimal("1.5"), "itemid": 10, "user_id": 1}
+    assert event_id_for(event) == event_id_for(reordered)
+    assert event_id_for(event) != event_id_for(dict(event, itemid=11))
+
+
+def test_event_id_matches_across_batch_formats():
+    legacy = io.BytesIO(json.dumps(EVENTS, default=str).encode("utf-8"))
+    payload, _ = encode_batch(json.loads(json.dumps(EVENTS, default=str)), compression="gzip")
+    legacy_ids = [event_id_for(event) for event in iter_batch_events(legacy)]
+    ndjson_ids = [event_id_for(event) for event in iter_batch_events(io.BytesIO(payload))]
+    assert legacy_ids == ndjson_ids
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1 << 20])
+def test_iter_json_array_across_chunk_boundaries(chunk_size):
+    text = json.dumps(EVENTS, indent=2, default=float)
+    events = list(iter_json_array(io.BytesIO(text.encode("utf-8")), chunk_size=chunk_size))
+    assert [event["itemid"] for event in events] == [10, 11, 12]
+    assert events[0]["price"] == Decimal("1.5")
+    assert events[1]["note"] == "a, b ] {c}"
+
+
+def test_iter_json_array_decodes_multibyte_characters_split_by_chunks():
+    data = json.dumps([{"name": "café ☃"}], ensure_ascii=False).encode("utf-8")
+    assert list(iter_json_array(io.BytesIO(data), chunk_size=1)) == [{"name": "café ☃"}]
+
+
+def test_iter_json_array_empty_and_invalid():
+    assert list(iter_json_array(io.BytesIO(b" [ ] "))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(b'{"user_id": 1}')))
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(b'[{"user_id": 1},'), chunk_size=4))
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "auto"])
+def test_encode_batch_round_trip(compression):
+    events = json.loads(json.dumps(EVENTS, default=str))
+    payload, suffix = encode_batch(events, compression=compression)
+    assert is_batch_key(f"batches/batch{suffix}")
+    assert list(iter_batch_events(io.BytesIO(payload))) == events
+
+
+def test_iter_batch_events_reads_gzipped_legacy_array():
+    payload = gzip.compress(json.dumps(EVENTS, default=str).encode("utf-8"))
+    assert [event["itemid"] for event in iter_batch_events(io.BytesIO(payload))] == [10, 11, 12]
+
+
+def test_to_table_item():
+    item = to_table_item(EVENTS[0])
+    assert item["user_id"] == "1"
+    assert item["event_date"] == "2024-01-01"
+    assert item["event_id"] == event_id_for(EVENTS[0])
+    assert to_table_item(EVENTS[2])["event_date"] == "unknown"
+    assert to_table_item({"itemid": 1}) is None
+    assert event_date_of("2024-13-01") == "unknown"
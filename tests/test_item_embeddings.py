@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.decomposition import IncrementalPCA
+
+from ML import item_embeddings
+
+
+def event_frame(rows, seed):
+    rng = np.random.default_rng(seed)
+    itemids = rng.integers(50, size=rows)
+    return pd.DataFrame({
+        "itemid": itemids,
+        "categoryid": [f"category {itemid % 7}" for itemid in itemids],
+        "available": rng.integers(2, size=rows),
+        "event_timestamp": [f"2024-01-01T{i % 24:02d}:{i % 60:02d}:00" for i in range(rows)],
+    })
+
+
+def test_merge_bucket_count_follows_the_row_budget():
+    assert item_embeddings.merge_bucket_count(0, bucket_rows=100) == 1
+    assert item_embeddings.merge_bucket_count(100, bucket_rows=100) == 1
+    assert item_embeddings.merge_bucket_count(101, bucket_rows=100) == 2
+
+
+def test_staged_buckets_match_the_batch_merge(tmp_path):
+    frames = [(f"file_{i}", event_frame(200, i)) for i in range(3)]
+    paths = item_embeddings.stage_item_buckets(iter(frames), str(tmp_path), n_buckets=4)
+    staged = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+    merged = item_embeddings.consolidate_items(
+        pd.concat([item_embeddings.consolidate_items(df) for _, df in frames], ignore_index=True)
+    )
+
+    assert len(paths) == 4
+    assert staged["itemid"].is_unique
+    pd.testing.assert_frame_equal(
+        staged.set_index("itemid").sort_index(), merged.set_index("itemid").sort_index(), check_like=True
+    )
+
+
+def test_reduce_features_densifies_in_chunks():
+    matrix = sp.random(50, 12, density=0.3, format="csr", dtype=np.float32, random_state=0)
+    reducer = IncrementalPCA(n_components=4).fit(matrix.toarray())
+
+    chunked = item_embeddings.reduce_features(reducer, matrix, chunk_rows=7)
+    assert chunked.dtype == np.float32 and chunked.shape == (50, 4)
+    np.testing.assert_allclose(chunked, reducer.transform(matrix.toarray()), rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(item_embeddings.reduce_features(None, matrix, chunk_rows=7), matrix.toarray())
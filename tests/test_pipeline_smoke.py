@@ -0,0 +1,177 @@
+"""End-to-end smoke test of raw batches -> DynamoDB -> training dataset -> embeddings -> FAISS, on moto."""
+import io
+import json
+
+import boto3
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+moto = pytest.importorskip("moto")
+
+from ML import artifact_bundle, build_training_dataset, item_embeddings, query_faiss, train_faiss_index
+from ML.event_batches import encode_batch
+from scripts import s3_to_dynamodb
+
+BUCKET = "ecom-raw-events"
+TABLE = "user_interactions"
+CATEGORIES = ["shoes running", "shoes hiking", "shirt cotton", "shirt linen", "hat wool"]
+
+
+class BotoInputFiles:
+    """pyarrow's S3 client is not intercepted by moto, so parquet reads go through boto3 here."""
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def open_input_file(self, path):
+        bucket, key = path.split("/", 1)
+        return pa.BufferReader(self.s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+
+def raw_events(n_users=30, n_items=40):
+    rng = np.random.default_rng(0)
+    events = []
+    for i in range(400):
+        itemid = int(rng.integers(n_items))
+        events.append({
+            "user_id": int(rng.integers(n_users)),
+            "itemid": itemid,
+            "event": "view",
+            "categoryid": CATEGORIES[itemid % len(CATEGORIES)],
+            "available": itemid % 2,
+            "event_timestamp": f"2024-01-{1 + i % 3:02d}T{i % 24:02d}:00:00",
+        })
+    events.append(dict(events[0]))  # a duplicate delivery collapses to the same event_id
+    return events
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    for name, value in (("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"), ("AWS_SESSION_TOKEN", "testing")):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        boto3.client("dynamodb", region_name="us-east-1").create_table(
+            TableName=TABLE,
+            KeySchema=[{"AttributeName": "event_id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "event_id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        # the modules created their clients at import time, outside the mock
+        for module in (s3_to_dynamodb, build_training_dataset, item_embeddings, artifact_bundle, train_faiss_index):
+            monkeypatch.setattr(module, "s3", boto3.client("s3", region_name="us-east-1"))
+        monkeypatch.setattr(s3_to_dynamodb, "dynamodb", boto3.client("dynamodb", region_name="us-east-1"))
+        monkeypatch.setattr(item_embeddings, "s3_filesystem", BotoInputFiles(s3))
+        monkeypatch.setattr(item_embeddings, "EMBEDDING_REFIT", True)
+        yield s3
+
+
+def test_import_export_train(aws, monkeypatch):
+    events = raw_events()
+    for part in range(2):
+        payload, suffix = encode_batch(events[part::2], compression="gzip")
+        aws.put_object(Bucket=BUCKET, Key=f"batches/batch_{part}{suffix}", Body=payload)
+    aws.put_object(Bucket=BUCKET, Key="batches/legacy.json", Body=json.dumps(events[:10]).encode("utf-8"))
+
+    # import: duplicates across batches and formats collapse onto content-derived event IDs
+    s3_to_dynamodb.s3_to_dynamodb(workers=2)
+    stored = boto3.client("dynamodb", region_name="us-east-1").scan(TableName=TABLE, Select="COUNT")["Count"]
+    assert stored == len({json.dumps(event, sort_keys=True) for event in events})
+
+    # export: one merged parquet file per date partition, and a watermark
+    monkeypatch.setattr(build_training_dataset, "MERGE_EXPORT_PARTITIONS", True)
+    build_training_dataset.scan_dynamodb_and_save_batches(total_segments=2, workers=2, resume=False, mode="full")
+    keys = sorted(obj["Key"] for obj in aws.list_objects_v2(Bucket=BUCKET, Prefix="train/event_date=")["Contents"])
+    assert [key.split("/")[1] for key in keys] == ["event_date=2024-01-01", "event_date=2024-01-02", "event_date=2024-01-03"]
+    watermark = json.loads(aws.get_object(Bucket=BUCKET, Key=build_training_dataset.watermark_key())["Body"].read())
+    assert watermark["event_timestamp"].startswith("2024-01-03")
+
+    # train: embeddings, then the FAISS index with its pinned manifest
+    item_embeddings.main()
+    train_faiss_index.main()
+    manifest = query_faiss.load_manifest()
+    index = query_faiss.load_faiss_index(manifest)
+    item_ids, vectors = query_faiss.load_item_bundle(manifest)
+    assert index.ntotal == len(item_ids) == len({event["itemid"] for event in events})
+    assert set(manifest["artifacts"]) >= {train_faiss_index.FAISS_INDEX_FILE, f"{train_faiss_index.ITEM_BUNDLE_PREFIX}/manifest.json"}
+
+    id_map = query_faiss.ItemIdMap(item_ids)
+    similar = query_faiss.get_similar_items(str(item_ids[0]), index, id_map, k=3, label_to_row=id_map.to_rows)
+    assert len(similar) == 3 and str(item_ids[0]) not in similar
+
+
+def partition_tables(s3, prefix):
+    """Every parquet file under prefix, read through boto3."""
+    return [
+        pq.read_table(io.BytesIO(s3.get_object(Bucket=BUCKET, Key=obj["Key"])["Body"].read()))
+        for obj in s3.list_objects_v2(Bucket=BUCKET, Prefix=prefix).get("Contents", [])
+        if obj["Key"].endswith(".parquet")
+    ]
+
+
+def partition_rows(s3, prefix):
+    return sum(table.num_rows for table in partition_tables(s3, prefix))
+
+
+def exported_event_ids(s3, prefix):
+    return sorted(event_id for table in partition_tables(s3, prefix) for event_id in table["event_id"].to_pylist())
+
+
+def test_incremental_export_does_not_repeat_invalid_timestamps(aws):
+    events = raw_events()[:40]
+    for i, event in enumerate(events[:5]):
+        event["event_timestamp"] = "INVALID_TIMESTAMP"
+        event["itemid"] = 1000 + i  # keeps the invalid events distinct from each other
+    payload, suffix = encode_batch(events, compression="gzip")
+    aws.put_object(Bucket=BUCKET, Key=f"batches/batch_0{suffix}", Body=payload)
+    s3_to_dynamodb.s3_to_dynamodb(workers=1)
+
+    build_training_dataset.scan_dynamodb_and_save_batches(total_segments=2, workers=2, resume=False, mode="full")
+    assert partition_rows(aws, "train/event_date=unknown/") == 5
+    total = partition_rows(aws, "train/event_date=")
+
+    for _ in range(2):
+        build_training_dataset.scan_dynamodb_and_save_batches(total_segments=2, workers=2, resume=False, mode="incremental")
+    assert partition_rows(aws, "train/event_date=unknown/") == 5
+    assert partition_rows(aws, "train/event_date=") == total
+
+
+def test_s3_and_dynamodb_sources_export_the_same_events(aws, monkeypatch):
+    events = raw_events()
+    for part in range(2):
+        payload, suffix = encode_batch(events[part::2], compression="gzip")
+        aws.put_object(Bucket=BUCKET, Key=f"batches/batch_{part}{suffix}", Body=payload)
+    aws.put_object(Bucket=BUCKET, Key="batches/legacy.json", Body=json.dumps(events[:10]).encode("utf-8"))
+
+    s3_to_dynamodb.s3_to_dynamodb(workers=2)
+    build_training_dataset.scan_dynamodb_and_save_batches(total_segments=2, workers=2, resume=False, mode="full")
+    monkeypatch.setattr(build_training_dataset, "OUTPUT_PREFIX", "compacted")
+    build_training_dataset.compact_raw_batches(workers=2)
+
+    from_table = exported_event_ids(aws, "train/event_date=")
+    assert len(from_table) == len(set(from_table)) == len({json.dumps(event, sort_keys=True) for event in events})
+    assert exported_event_ids(aws, "compacted/event_date=") == from_table
+
+
+def test_import_checkpoint_markers(aws, monkeypatch):
+    events = raw_events()[:20]
+    for part in range(2):
+        payload, suffix = encode_batch(events[part::2], compression="gzip")
+        aws.put_object(Bucket=BUCKET, Key=f"batches/batch_{part}{suffix}", Body=payload)
+    aws.put_object(Bucket=BUCKET, Key=s3_to_dynamodb.LEGACY_CHECKPOINT_KEY,
+                   Body=json.dumps({"completed": ["batches/old.json"]}).encode("utf-8"))
+    s3_to_dynamodb.s3_to_dynamodb(workers=2)
+
+    markers = aws.list_objects_v2(Bucket=BUCKET, Prefix=f"{s3_to_dynamodb.IMPORT_CHECKPOINT_PREFIX}/")["Contents"]
+    assert len(markers) == 2
+    checkpoint = s3_to_dynamodb.Checkpoint()
+    assert checkpoint.completed == {"batches/batch_0.ndjson.gz", "batches/batch_1.ndjson.gz", "batches/old.json"}
+
+    # a rerun finds every batch checkpointed and writes nothing
+    imported = []
+    monkeypatch.setattr(s3_to_dynamodb, "import_batch", lambda s3_key, checkpoint: imported.append(s3_key))
+    s3_to_dynamodb.s3_to_dynamodb(workers=2)
+    assert imported == []
@@ -0,0 +1,96 @@
+import hashlib
+import os
+
+import numpy as np
+import pytest
+
+from ML import artifact_bundle, query_faiss
+from ML.query_faiss import ItemIdMap, build_user_vectors, recency_weights
+
+
+def test_item_id_map_round_trip():
+    id_map = ItemIdMap(np.array([3, 7, 42, 1000], dtype=np.int64))
+    assert len(id_map) == 4
+    assert id_map.to_rows([42, 3, 1000]).tolist() == [2, 0, 3]
+    assert id_map.to_ids([2, 0, 3]).tolist() == [42, 3, 1000]
+    assert id_map.row(7) == 1
+    assert 7 in id_map and 8 not in id_map
+
+
+def test_item_id_map_unknown_and_padding():
+    id_map = ItemIdMap([3, 7, 42])
+    # unknown, beyond the largest id, non-numeric, and a FAISS padding label
+    assert id_map.to_rows(np.array(["8", "9999", "abc", "-1"], dtype=object)).tolist() == [-1, -1, -1, -1]
+    assert id_map.to_rows(["42", "3"]).tolist() == [2, 0]
+    assert id_map.to_ids(np.array([[1, -1]])).tolist() == [[7, -1]]
+
+
+def test_item_id_map_maps_result_matrices():
+    id_map = ItemIdMap([10, 20, 30])
+    labels = np.array([[30, 10, -1], [20, 20, 30]])
+    assert id_map.to_rows(labels).tolist() == [[2, 0, -1], [1, 1, 2]]
+
+
+def test_item_id_map_empty():
+    assert ItemIdMap(np.array([], dtype=np.int64)).to_rows([1, 2]).tolist() == [-1, -1]
+
+
+@pytest.mark.parametrize("item_ids", [[3, 1, 2], [1, 1, 2], [[1, 2]]])
+def test_item_id_map_rejects_unsorted_duplicate_or_2d_ids(item_ids):
+    with pytest.raises(ValueError):
+        ItemIdMap(item_ids)
+
+
+def test_recency_weights_halve_per_half_life():
+    weights = recency_weights(["2024-01-11T00:00:00", "2024-01-10T00:00:00", "2024-01-01T00:00:00"], half_life_days=1)
+    np.testing.assert_allclose(weights, [1.0, 0.5, 0.5 ** 10], rtol=1e-6)
+    assert weights.dtype == np.float32
+
+
+@pytest.mark.parametrize("timestamps,half_life_days", [
+    (["2024-01-02", "2024-01-01"], 0),
+    (["2024-01-02", "INVALID_TIMESTAMP"], 7),
+    (["2024-01-02", None], 7),
+])
+def test_recency_weights_fall_back_to_uniform(timestamps, half_life_days):
+    assert recency_weights(timestamps, half_life_days).tolist() == [1.0, 1.0]
+
+
+def test_recency_weights_empty_history():
+    assert len(recency_weights([], 7)) == 0
+
+
+def test_build_user_vectors_matches_per_user_weighted_average():
+    rng = np.random.default_rng(0)
+    item_vectors = rng.random((20, 4)).astype(np.float32)
+    rows_per_user = [np.array([0, 5, 7]), np.array([3]), np.array([19, 19, 2, 11])]
+    weights_per_user = [np.array([1.0, 0.5, 0.25]), np.array([2.0]), np.ones(4)]
+
+    user_vectors = build_user_vectors(item_vectors, rows_per_user, weights_per_user)
+
+    expected = [np.average(item_vectors[rows], axis=0, weights=weights) for rows, weights in zip(rows_per_user, weights_per_user)]
+    assert user_vectors.shape == (3, 4) and user_vectors.dtype == np.float32
+    np.testing.assert_allclose(user_vectors, expected, rtol=1e-5)
+
+
+def test_build_user_vectors_accepts_float16_vectors():
+    item_vectors = np.array([[1, 0], [0, 1]], dtype=np.float16)
+    user_vectors = build_user_vectors(item_vectors, [np.array([0, 1])], [np.array([3.0, 1.0])])
+    np.testing.assert_allclose(user_vectors, [[0.75, 0.25]])
+
+
+def test_download_verifies_the_checksum_once(tmp_path, monkeypatch):
+    payload = b"vectors"
+    hashed = []
+    monkeypatch.setattr(query_faiss, "ARTIFACT_DIR", str(tmp_path))
+    monkeypatch.setattr(artifact_bundle, "download_object", lambda s3, key, path, pin: open(path, "wb").write(payload))
+    monkeypatch.setattr(artifact_bundle, "file_sha256", lambda path: hashed.append(path) or hashlib.sha256(payload).hexdigest())
+
+    with pytest.raises(ValueError):
+        query_faiss.download_artifact_version(None, "bundle/vectors.npy", '"bad"', sha256="0" * 64)
+    assert not any(name.endswith(".bad") or name.endswith(".part") for name in os.listdir(tmp_path))
+
+    sha256 = hashlib.sha256(payload).hexdigest()
+    path = query_faiss.download_artifact_version(None, "bundle/vectors.npy", '"good"', sha256=sha256)
+    assert query_faiss.download_artifact_version(None, "bundle/vectors.npy", '"good"', sha256=sha256) == path
+    assert len(hashed) == 2  # the failed download and the first good one; the cached copy is not hashed
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("httpx")  # required by fastapi's TestClient
+
+from fastapi.testclient import TestClient
+
+from api import recommend
+
+# no startup event runs, so no artifacts are loaded; validation rejects these before any handler
+client = TestClient(recommend.app)
+
+
+@pytest.mark.parametrize("k", [-1, 0, recommend.MAX_K + 1])
+def test_item_and_user_endpoints_reject_out_of_range_k(k):
+    assert client.get(f"/recommend/1?k={k}").status_code == 422
+    assert client.get(f"/recommend_user/1?k={k}").status_code == 422
+
+
+@pytest.mark.parametrize("k", [-1, 0, recommend.MAX_K + 1])
+def test_batch_endpoint_rejects_out_of_range_k(k):
+    assert client.post("/recommend_users", json={"user_ids": ["1"], "k": k}).status_code == 422
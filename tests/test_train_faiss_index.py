@@ -0,0 +1,38 @@
+import numpy as np
+
+from ML.train_faiss_index import diff_items
+
+
+def test_diff_items_classifies_added_changed_removed():
+    old_ids = np.array([1, 2, 3, 4], dtype=np.int64)
+    old_vectors = np.array([[0, 0], [1, 1], [2, 2], [3, 3]], dtype=np.float32)
+    new_ids = np.array([2, 3, 4, 5], dtype=np.int64)
+    new_vectors = np.array([[1, 1], [2, 2.5], [3, 3], [5, 5]], dtype=np.float32)
+
+    removed_ids, upsert_ids, upsert_vectors = diff_items(old_ids, old_vectors, new_ids, new_vectors)
+
+    assert removed_ids.tolist() == [1]
+    assert upsert_ids.tolist() == [3, 5]
+    np.testing.assert_array_equal(upsert_vectors, [[2, 2.5], [5, 5]])
+
+
+def test_diff_items_ignores_changes_within_tolerance():
+    ids = np.array([1, 2], dtype=np.int64)
+    old_vectors = np.array([[0.5, 0.5], [1, 1]], dtype=np.float16)
+    new_vectors = np.array([[0.5, 0.5001], [1, 1]], dtype=np.float32)
+
+    removed_ids, upsert_ids, _ = diff_items(ids, old_vectors, ids, new_vectors, tolerance=1e-3)
+    assert len(removed_ids) == 0 and len(upsert_ids) == 0
+
+    _, upsert_ids, _ = diff_items(ids, old_vectors, ids, new_vectors, tolerance=1e-6)
+    assert upsert_ids.tolist() == [1]
+
+
+def test_diff_items_from_empty_catalog():
+    new_ids = np.array([7, 9], dtype=np.int64)
+    new_vectors = np.ones((2, 3), dtype=np.float32)
+    removed_ids, upsert_ids, upsert_vectors = diff_items(
+        np.array([], dtype=np.int64), np.empty((0, 3), dtype=np.float32), new_ids, new_vectors
+    )
+    assert len(removed_ids) == 0
+    assert upsert_ids.tolist() == [7, 9] and upsert_vectors.shape == (2, 3)